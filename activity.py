@@ -0,0 +1,160 @@
+import asyncio
+import logging
+import math
+import time
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+from sqlalchemy import func, select, text, update
+
+from database import AsyncSessionLocal, User
+from replica import read_session
+
+
+ACTIVITY_FLUSH_SECONDS = 60
+TOTAL_REFRESH_SECONDS = 60
+
+logger = logging.getLogger(__name__)
+
+started_at = time.time()
+
+# Кто был активен в каждую минуту последнего часа и в каждый час последних суток
+_minutes: dict[int, set[int]] = {}
+_hours: dict[int, set[int]] = {}
+_pending_seen: set[int] = set()
+_last_written: dict[int, float] = {}
+
+_total_estimate = 0
+_total_refreshed_at: float | None = None
+_db_counts: dict[int, tuple[float, int]] = {}
+_flush_task: asyncio.Task | None = None
+
+
+def _prune(minute: int):
+    for old in [m for m in _minutes if m <= minute - 60]:
+        del _minutes[old]
+    for old in [h for h in _hours if h <= minute // 60 - 24]:
+        del _hours[old]
+
+
+def record(user_id: int):
+    now = time.time()
+    minute = int(now // 60)
+    users = _minutes.get(minute)
+    if users is None:
+        users = _minutes[minute] = set()
+        _prune(minute)
+    users.add(user_id)
+    _hours.setdefault(minute // 60, set()).add(user_id)
+
+    # last_seen_at в базе обновляется не чаще раза в минуту на игрока
+    if now - _last_written.get(user_id, 0) >= ACTIVITY_FLUSH_SECONDS:
+        _pending_seen.add(user_id)
+
+
+class ActivityMiddleware(BaseMiddleware):
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        if user is not None and not user.is_bot:
+            record(user.id)
+        return await handler(event, data)
+
+
+async def flush():
+    if not _pending_seen:
+        return
+
+    user_ids = list(_pending_seen)
+    _pending_seen.clear()
+    now = time.time()
+    try:
+        async with AsyncSessionLocal() as session:
+            await session.execute(
+                update(User)
+                .where(User.user_id.in_(user_ids))
+                .values(last_seen_at=datetime.utcnow())
+            )
+            await session.commit()
+    except Exception:
+        # Не записали — попробуем в следующий раз
+        _pending_seen.update(user_ids)
+        raise
+
+    for user_id in user_ids:
+        _last_written[user_id] = now
+    for user_id in [u for u, written in _last_written.items() if now - written >= ACTIVITY_FLUSH_SECONDS]:
+        del _last_written[user_id]
+
+
+async def _flush_loop():
+    while True:
+        await asyncio.sleep(ACTIVITY_FLUSH_SECONDS)
+        try:
+            await flush()
+        except Exception:
+            logger.exception("Failed to flush activity")
+
+
+async def start():
+    global _flush_task
+    _flush_task = asyncio.create_task(_flush_loop())
+
+
+async def stop():
+    if _flush_task is not None:
+        _flush_task.cancel()
+    await flush()
+
+
+def _memory_count(seconds: int) -> int:
+    now = time.time()
+    if seconds <= 3600:
+        minute = int(now // 60)
+        buckets = [_minutes.get(m, ()) for m in range(minute - math.ceil(seconds / 60) + 1, minute + 1)]
+    else:
+        hour = int(now // 3600)
+        buckets = [_hours.get(h, ()) for h in range(hour - math.ceil(seconds / 3600) + 1, hour + 1)]
+    return len(set().union(*buckets))
+
+
+async def _db_count(seconds: int) -> int:
+    cached = _db_counts.get(seconds)
+    if cached is not None and time.monotonic() - cached[0] < ACTIVITY_FLUSH_SECONDS:
+        return cached[1]
+
+    threshold = datetime.utcnow() - timedelta(seconds=seconds)
+    async with read_session() as session:
+        count = await session.scalar(
+            select(func.count()).select_from(User).where(User.last_seen_at >= threshold)
+        )
+    _db_counts[seconds] = (time.monotonic(), count or 0)
+    return count or 0
+
+
+async def active_count(seconds: int) -> int:
+    # В памяти только игроки этого процесса и только с его старта, а база общая для всех
+    # процессов, но отстаёт на интервал записи last_seen_at — берём большее
+    return max(_memory_count(seconds), await _db_count(seconds))
+
+
+async def total_users() -> int:
+    global _total_estimate, _total_refreshed_at
+    if _total_refreshed_at is None or time.monotonic() - _total_refreshed_at >= TOTAL_REFRESH_SECONDS:
+        # n_live_tup растёт с каждой вставкой из любого процесса (бот, веб-API, рефералы), без ANALYZE
+        async with read_session() as session:
+            estimate = await session.scalar(
+                text("SELECT n_live_tup FROM pg_stat_user_tables WHERE relid = 'users'::regclass")
+            )
+            if not estimate:
+                # Статистика сброшена или таблица пустая — считаем честно
+                estimate = await session.scalar(select(func.count()).select_from(User))
+        _total_estimate = estimate or 0
+        _total_refreshed_at = time.monotonic()
+    return _total_estimate
@@ -0,0 +1,138 @@
+import hashlib
+import hmac
+import json
+import math
+import os
+import time
+from contextlib import asynccontextmanager
+from urllib.parse import parse_qsl
+
+from fastapi import Depends, FastAPI, Header, HTTPException
+from fastapi.responses import FileResponse
+from fastapi.staticfiles import StaticFiles
+from pydantic import BaseModel, Field
+
+import game
+import ledger
+import user_cache
+from sweeper import IdleSweeper
+
+
+BOT_TOKEN = os.getenv("BOT_TOKEN")
+WEBAPP_AUTH_TTL = int(os.getenv("WEBAPP_AUTH_TTL", "86400"))
+WEB_MAX_TAPS_PER_SECOND = float(os.getenv("WEB_MAX_TAPS_PER_SECOND", "20"))
+WEB_MAX_BATCH_WINDOW_MS = 5000
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Тапы из веба тоже пишутся в журнал баланса, его буфер сбрасывает этот процесс
+    await ledger.start()
+    await user_cache.start()
+    try:
+        yield
+    finally:
+        await user_cache.stop()
+        await ledger.stop()
+
+
+app = FastAPI(lifespan=lifespan)
+app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
+
+# Когда игрок в последний раз прислал пачку тапов — окно клиента не может быть длиннее реального
+_last_batch_at: dict[int, float] = {}
+# Пачка старше максимального окна уже ничего не ограничивает
+_sweeper = IdleSweeper(
+    _last_batch_at,
+    WEB_MAX_BATCH_WINDOW_MS / 1000,
+    lambda user_id, at, now: now - at >= WEB_MAX_BATCH_WINDOW_MS / 1000,
+)
+
+
+class TapBatch(BaseModel):
+    count: int = Field(ge=1)
+    window_ms: int = Field(ge=1)
+
+
+# -------- АВТОРИЗАЦИЯ --------
+def _secret_key() -> bytes:
+    return hmac.new(b"WebAppData", BOT_TOKEN.encode(), hashlib.sha256).digest()
+
+
+def verify_init_data(init_data: str) -> int:
+    fields = dict(parse_qsl(init_data, keep_blank_values=True))
+    received_hash = fields.pop("hash", "")
+    check_string = "\n".join(f"{key}={value}" for key, value in sorted(fields.items()))
+    expected_hash = hmac.new(_secret_key(), check_string.encode(), hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(expected_hash, received_hash):
+        raise HTTPException(status_code=401, detail="bad init data")
+
+    auth_date = int(fields.get("auth_date", "0"))
+    if time.time() - auth_date > WEBAPP_AUTH_TTL:
+        raise HTTPException(status_code=401, detail="init data expired")
+
+    try:
+        return int(json.loads(fields["user"])["id"])
+    except (KeyError, ValueError, TypeError):
+        raise HTTPException(status_code=401, detail="no user in init data")
+
+
+async def current_user_id(authorization: str = Header("")) -> int:
+    # Клиент шлёт Telegram.WebApp.initData в заголовке "Authorization: tma <initData>"
+    scheme, _, init_data = authorization.partition(" ")
+    if scheme.lower() != "tma" or not init_data:
+        raise HTTPException(status_code=401, detail="missing init data")
+    return verify_init_data(init_data)
+
+
+# -------- СОСТОЯНИЕ --------
+def compact_state(row) -> dict:
+    return {
+        "balance": row.balance,
+        "energy": int(row.energy),
+        "max_energy": row.max_energy,
+        "tap_power": row.tap_power,
+        "energy_regen": row.energy_regen,
+        "auto_farm_level": row.auto_farm_level if row.auto_farm_enabled else 0,
+    }
+
+
+def allowed_taps(user_id: int, batch: TapBatch) -> int:
+    # Больше, чем можно натапать за прошедшее время, не засчитываем; энергию проверит сам UPDATE
+    now = time.monotonic()
+    _sweeper.sweep(now)
+    window = min(batch.window_ms, WEB_MAX_BATCH_WINDOW_MS) / 1000
+    last_batch_at = _last_batch_at.get(user_id)
+    if last_batch_at is not None:
+        window = min(window, now - last_batch_at)
+    _last_batch_at[user_id] = now
+    return min(batch.count, math.ceil(window * WEB_MAX_TAPS_PER_SECOND))
+
+
+@app.get("/")
+async def index():
+    return FileResponse(os.path.join(STATIC_DIR, "index.html"))
+
+
+@app.get("/api/state")
+async def state(user_id: int = Depends(current_user_id)):
+    row = await game.get_state(user_id)
+    if row is None:
+        raise HTTPException(status_code=404, detail="start the bot first")
+    return compact_state(row)
+
+
+@app.post("/api/tap")
+async def tap(batch: TapBatch, user_id: int = Depends(current_user_id)):
+    count = allowed_taps(user_id, batch)
+    if count == 0:
+        row = await game.get_state(user_id)
+    else:
+        # Пишем сразу в базу: буфер тапов бота (tap_buffer) пишет дельтами и эту запись не затрёт,
+        # а свой снимок игрока забудет по NOTIFY от user_cache.store
+        row, _ = await game.tap(user_id, count)
+    if row is None:
+        raise HTTPException(status_code=404, detail="start the bot first")
+    return compact_state(row)
@@ -0,0 +1,92 @@
+import asyncio
+import logging
+from datetime import datetime
+
+from sqlalchemy import insert, select
+
+from database import AdminAction, AsyncSessionLocal
+
+
+AUDIT_FLUSH_SECONDS = 2
+AUDIT_FLUSH_CHUNK = 500
+AUDIT_PAGE_SIZE = 15
+
+logger = logging.getLogger(__name__)
+
+_buffer: list[dict] = []
+_flush_lock = asyncio.Lock()
+_flush_task: asyncio.Task | None = None
+
+
+def record(actor_id: int, action: str, target_id: int | None = None, value=None):
+    # Хендлер не ждёт базу: запись уходит пачкой из фоновой задачи
+    _buffer.append({
+        "actor_id": actor_id,
+        "action": action,
+        "target_id": target_id,
+        "value": None if value is None else str(value),
+        "created_at": datetime.utcnow(),
+    })
+
+
+async def flush():
+    async with _flush_lock:
+        if not _buffer:
+            return
+
+        rows = _buffer[:]
+        del _buffer[:len(rows)]
+        try:
+            async with AsyncSessionLocal() as session:
+                for start in range(0, len(rows), AUDIT_FLUSH_CHUNK):
+                    await session.execute(insert(AdminAction).values(rows[start:start + AUDIT_FLUSH_CHUNK]))
+                await session.commit()
+        except Exception:
+            # Не теряем записи: вернутся в начало буфера и уйдут со следующей попыткой
+            _buffer[:0] = rows
+            raise
+
+
+async def _flush_loop():
+    while True:
+        await asyncio.sleep(AUDIT_FLUSH_SECONDS)
+        try:
+            await flush()
+        except Exception:
+            logger.exception("Failed to write admin actions")
+
+
+async def start():
+    global _flush_task
+    _flush_task = asyncio.create_task(_flush_loop())
+
+
+async def stop():
+    if _flush_task is not None:
+        _flush_task.cancel()
+    await flush()
+
+
+async def fetch_page(
+    before_id: int | None = None,
+    actor_id: int | None = None,
+    target_id: int | None = None,
+    since: datetime | None = None,
+    limit: int = AUDIT_PAGE_SIZE,
+) -> tuple[list[AdminAction], bool]:
+    # Постранично по id от новых к старым: каждая страница — короткий проход по индексу
+    await flush()
+
+    stmt = select(AdminAction).order_by(AdminAction.id.desc()).limit(limit + 1)
+    if before_id is not None:
+        stmt = stmt.where(AdminAction.id < before_id)
+    if actor_id is not None:
+        stmt = stmt.where(AdminAction.actor_id == actor_id)
+    if target_id is not None:
+        stmt = stmt.where(AdminAction.target_id == target_id)
+    if since is not None:
+        stmt = stmt.where(AdminAction.created_at >= since)
+
+    async with AsyncSessionLocal() as session:
+        rows = (await session.execute(stmt)).scalars().all()
+    return rows[:limit], len(rows) > limit
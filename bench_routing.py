@@ -0,0 +1,92 @@
+import argparse
+import asyncio
+import time
+
+from aiogram import Bot, Dispatcher, F
+from aiogram.types import Update
+
+import routing
+from fake_sender import make_update
+
+
+PENDING_STATES = ("owner_grant_admin", "owner_take_admin", "password", "broadcast", "grant")
+
+
+class DictNamespace:
+    # Хранилище состояния без базы: сравниваем только стоимость маршрутизации
+    def __init__(self):
+        self.values: dict[int, dict] = {}
+
+    def __contains__(self, key: int) -> bool:
+        return key in self.values
+
+    def get(self, key: int, default=None):
+        return self.values.get(key, default)
+
+    async def put(self, key: int, value=True):
+        self.values[key] = value
+
+    async def discard(self, key: int):
+        self.values.pop(key, None)
+
+
+async def noop(message):
+    return None
+
+
+def linear_dispatcher(buttons: list[str]) -> Dispatcher:
+    # Как было: ожидание ввода — lambda-фильтры, кнопки — F.text == "...", всё проверяется по порядку
+    dp = Dispatcher()
+    pending = {state: DictNamespace() for state in PENDING_STATES}
+    for state in PENDING_STATES:
+        dp.message.register(noop, lambda message, ns=pending[state]: message.from_user.id in ns and bool(message.text))
+    for text in buttons:
+        dp.message.register(noop, F.text == text)
+    return dp
+
+
+def routed_dispatcher(buttons: list[str]) -> Dispatcher:
+    dp = Dispatcher()
+    menu = routing.TextRouter(DictNamespace())
+    routing.install(dp, menu)
+    for state in PENDING_STATES:
+        menu.input(state)(noop)
+    for text in buttons:
+        menu.text(text)(noop)
+    return dp
+
+
+async def measure(dp: Dispatcher, bot: Bot, text: str, updates: int) -> float:
+    batch = [Update.model_validate(make_update(1, text)) for _ in range(updates)]
+    for update in batch[:100]:
+        await dp.feed_update(bot, update)
+
+    started = time.perf_counter()
+    for update in batch:
+        await dp.feed_update(bot, update)
+    return (time.perf_counter() - started) / updates * 1_000_000
+
+
+async def run(sizes: list[int], updates: int):
+    bot = Bot("42:BENCH")
+    print(f"{'кнопок':>8} {'фильтры, мкс':>14} {'словарь, мкс':>14} {'ускорение':>10}")
+    for size in sizes:
+        # Худший случай для цепочки фильтров — последняя зарегистрированная кнопка
+        buttons = [f"Кнопка {i}" for i in range(size)]
+        text = buttons[-1]
+        linear = await measure(linear_dispatcher(buttons), bot, text, updates)
+        routed = await measure(routed_dispatcher(buttons), bot, text, updates)
+        print(f"{size:>8} {linear:>14.1f} {routed:>14.1f} {linear / routed:>9.1f}x")
+    await bot.session.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сравнение маршрутизации кнопок меню: фильтры против словаря")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[15, 50, 200])
+    parser.add_argument("--updates", type=int, default=5000)
+    args = parser.parse_args()
+    asyncio.run(run(args.sizes, args.updates))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,37 @@
 import asyncio
-from datetime import datetime
-from datetime import timedelta
+from datetime import datetime, timedelta
 
 from aiogram import Bot, Dispatcher, F
 from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, WebAppInfo
 from aiogram.filters import Command
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
 
-from sqlalchemy import select, desc, func, or_, text
+from sqlalchemy import select
 
 import os
 import secrets
-from database import AsyncSessionLocal, User
+import activity
+import audit
+import broadcast
+import farm_settlement
+import game
+import leaderboard
+import ledger
+import metrics
+import migrations
+import outbound
+import players
+import replica
+import routing
+import state_store
+import tap_buffer
+import tap_panel
+import throttling
+import user_cache
+import webhook
+from database import AsyncSessionLocal, User, pool_stats, warm_up_pool
 
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
@@ -21,6 +39,8 @@ BLOCKED_TOP_USER_ID = 8375181976
 OWNER_ID = 8375181976
 REFERRAL_REWARD = 150000
 REFERRED_USER_REWARD = 75000
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEB_APP_URL = os.getenv("WEB_APP_URL")
 
 bot = Bot(
     token=BOT_TOKEN,
@@ -28,20 +48,27 @@ bot = Bot(
 )
 
 dp = Dispatcher()
+dp.update.outer_middleware(players.PlayerDirectoryMiddleware())
+dp.update.outer_middleware(activity.ActivityMiddleware())
+outbound.install(dp, bot)
+metrics.instrument(dp, bot)
+dp.message.middleware(throttling.ThrottlingMiddleware())
+dp.callback_query.middleware(throttling.ThrottlingMiddleware())
+leaderboard.blocked_user_ids.add(BLOCKED_TOP_USER_ID)
 
 ADMIN_PANEL_PASSWORD = "adam404"
-admin_sessions: set[int] = set()
-pending_password: set[int] = set()
-pending_grant: dict[int, dict[str, str | None]] = {}
-pending_broadcast: set[int] = set()
-pending_owner_grant_admin: set[int] = set()
-pending_owner_take_admin: set[int] = set()
-admin_action_log: list[str] = []
+ADMIN_SESSION_TTL = int(os.getenv("ADMIN_SESSION_TTL", "86400"))
+PENDING_INPUT_TTL = int(os.getenv("PENDING_INPUT_TTL", "600"))
+admin_sessions = state_store.Namespace("admin_sessions", ADMIN_SESSION_TTL)
+# Чего бот ждёт от игрока следующим сообщением: {"state": "password" | "grant" | ..., ...данные}
+pending_input = state_store.Namespace("pending_input", PENDING_INPUT_TTL)
+menu = routing.TextRouter(pending_input)
+routing.install(dp, menu)
 
 
 base_main_keyboard = ReplyKeyboardMarkup(
     keyboard=[
-        [KeyboardButton(text="👇 Тап")],
+        [KeyboardButton(text="👇 Тап"), KeyboardButton(text="🎯 Тап-панель")],
         [KeyboardButton(text="🛠 Улучшения")],
         [KeyboardButton(text="🏆 Рейтинг")],
         [KeyboardButton(text="📊 Профиль")],
@@ -57,6 +84,7 @@ upgrades_keyboard = ReplyKeyboardMarkup(
         [KeyboardButton(text="💵 Купить энергию")],
         [KeyboardButton(text="🔋 Увеличить макс. энергию")],
         [KeyboardButton(text="🤖 Авто-фарм")],
+        [KeyboardButton(text="📦 Купить оптом")],
         [KeyboardButton(text="⬅️ Назад")],
     ],
     resize_keyboard=True,
@@ -85,6 +113,12 @@ admin_keyboard = InlineKeyboardMarkup(
     ]
 )
 
+tap_panel_keyboard = InlineKeyboardMarkup(
+    inline_keyboard=[
+        [InlineKeyboardButton(text="👇 Тап", callback_data="tap")],
+    ]
+)
+
 owner_keyboard = InlineKeyboardMarkup(
     inline_keyboard=[
         [InlineKeyboardButton(text="🛡 Открыть админку", callback_data="owner_open_admin")],
@@ -108,7 +142,7 @@ def get_main_keyboard(user_id: int) -> ReplyKeyboardMarkup:
     if is_owner(user_id):
         return ReplyKeyboardMarkup(
             keyboard=[
-                [KeyboardButton(text="👇 Тап")],
+                [KeyboardButton(text="👇 Тап"), KeyboardButton(text="🎯 Тап-панель")],
                 [KeyboardButton(text="🛠 Улучшения")],
                 [KeyboardButton(text="🏆 Рейтинг")],
                 [KeyboardButton(text="📊 Профиль")],
@@ -120,15 +154,12 @@ def get_main_keyboard(user_id: int) -> ReplyKeyboardMarkup:
     return base_main_keyboard
 
 
-def log_admin_action(actor_id: int, action: str):
-    timestamp = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-    admin_action_log.append(f"[{timestamp}] {actor_id}: {action}")
-    if len(admin_action_log) > 200:
-        del admin_action_log[:-200]
+def log_admin_action(actor_id: int, action: str, target_id: int | None = None, value=None):
+    audit.record(actor_id, action, target_id, value)
 
 
 async def send_admin_list_message(message: Message):
-    async with AsyncSessionLocal() as session:
+    async with replica.read_session() as session:
         result = await session.execute(select(User).where(User.admin_rights.is_(True)))
         admins = result.scalars().all()
 
@@ -143,40 +174,78 @@ async def send_admin_list_message(message: Message):
     await message.answer("📋 Список администрации:\n" + "\n".join(lines))
 
 
-async def send_admin_actions_message(message: Message):
-    if not admin_action_log:
+def format_admin_action(entry) -> str:
+    line = f"[{entry.created_at:%Y-%m-%d %H:%M:%S}] {entry.actor_id}: {entry.action}"
+    if entry.target_id is not None:
+        line += f" → {entry.target_id}"
+    if entry.value is not None:
+        line += f" ({entry.value})"
+    return line
+
+
+def parse_admin_actions_filters(args: list[str]) -> dict:
+    # /adminactions7623 actor=123 target=456 hours=24
+    filters = {"actor_id": None, "target_id": None, "since": None}
+    for arg in args:
+        key, _, value = arg.partition("=")
+        if not value.isdigit():
+            continue
+        if key == "actor":
+            filters["actor_id"] = int(value)
+        elif key == "target":
+            filters["target_id"] = int(value)
+        elif key == "hours":
+            filters["since"] = int((datetime.utcnow() - timedelta(hours=int(value))).timestamp())
+    return filters
+
+
+async def send_admin_actions_message(
+    message: Message,
+    actor_id: int | None = None,
+    target_id: int | None = None,
+    since: int | None = None,
+    before_id: int | None = None,
+    edit: bool = False,
+):
+    entries, has_more = await audit.fetch_page(
+        before_id=before_id,
+        actor_id=actor_id,
+        target_id=target_id,
+        since=datetime.fromtimestamp(since) if since is not None else None,
+    )
+    if not entries and before_id is None:
         await message.answer("Лог действий администрации пока пуст")
         return
 
-    text_log = "\n".join(admin_action_log[-30:])
-    await message.answer(f"🧾 Последние действия администрации:\n\n{text_log}")
+    text_log = "\n".join(format_admin_action(entry) for entry in entries)
+    text = f"🧾 Действия администрации:\n\n{text_log}"
 
+    # В callback_data фильтры и id последней показанной записи: следующая страница продолжает с него
+    filters = ":".join("" if value is None else str(value) for value in (actor_id, target_id, since))
+    buttons = []
+    if before_id is not None:
+        buttons.append(InlineKeyboardButton(text="⏮ Сначала", callback_data=f"audit:{filters}:"))
+    if has_more:
+        buttons.append(InlineKeyboardButton(text="Старше ➡️", callback_data=f"audit:{filters}:{entries[-1].id}"))
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
 
-def generate_referral_code(user_id: int) -> str:
-    return f"ref{user_id}_{secrets.token_hex(4)}"
-
-
-# -------- ЭНЕРГИЯ --------
-async def update_energy(user: User):
-    now = datetime.utcnow()
-    seconds = (now - user.last_energy_update).total_seconds()
-
-    regen = seconds * user.energy_regen
-    user.energy = min(user.max_energy, user.energy + regen)
-    user.last_energy_update = now
+    if edit:
+        await message.edit_text(text, reply_markup=keyboard)
+    else:
+        await message.answer(text, reply_markup=keyboard)
 
 
-# -------- АВТОФАРМ --------
-async def update_auto_farm(user: User):
-    if not user.auto_farm_enabled or user.auto_farm_level == 0:
-        return
+def log_broadcast_finished(job, counters: dict[str, int]):
+    log_admin_action(
+        job.admin_id,
+        "broadcast_finished",
+        value=f"#{job.id} delivered={counters['sent']}, "
+        f"failed={counters['failed']}, blocked={counters['blocked']}",
+    )
 
-    now = datetime.utcnow()
-    seconds = (now - user.last_farm_update).total_seconds()
 
-    earned = int(seconds * user.auto_farm_level)
-    user.balance += earned
-    user.last_farm_update = now
+def generate_referral_code(user_id: int) -> str:
+    return f"ref{user_id}_{secrets.token_hex(4)}"
 
 
 # -------- START --------
@@ -189,8 +258,15 @@ async def start_handler(message: Message):
         user = result.scalar_one_or_none()
 
         is_new_user = user is None
+        if not is_new_user and user.bot_blocked:
+            user.bot_blocked = False
+
         if is_new_user:
-            user = User(user_id=message.from_user.id)
+            user = User(
+                user_id=message.from_user.id,
+                username=message.from_user.username,
+                first_name=message.from_user.first_name,
+            )
             session.add(user)
 
         referral_bonus_text = ""
@@ -211,6 +287,9 @@ async def start_handler(message: Message):
                 inviter = inviter_result.scalar_one_or_none()
 
             if inviter and inviter.user_id != message.from_user.id:
+                # Сначала сбрасываем тапы, потом блокируем строку: фоновое начисление фарма её пропустит
+                await tap_buffer.settle(inviter.user_id)
+                await session.refresh(inviter, with_for_update=True)
                 user.invited_by = inviter.user_id
                 inviter.balance += REFERRAL_REWARD
                 inviter.referrals_count += 1
@@ -222,8 +301,18 @@ async def start_handler(message: Message):
                 )
 
         await session.commit()
+        user_cache.store(user)
+        if referral_bonus_text:
+            user_cache.store(inviter)
+
+        if referral_bonus_text:
+            ledger.record(inviter.user_id, REFERRAL_REWARD, "referral")
+            ledger.record(user.user_id, REFERRED_USER_REWARD, "referral_bonus")
+            leaderboard.observe("balance", inviter.user_id, inviter.balance)
+            leaderboard.observe("balance", user.user_id, user.balance)
 
         username = message.from_user.first_name or message.from_user.username or "фермер"
+        now = datetime.utcnow()
 
         await message.answer(
             f"👋 Добро пожаловать, {username}!\n\n"
@@ -233,31 +322,46 @@ async def start_handler(message: Message):
             f"богатым фермером!\n\n"
             f"🤝 Приятной игры!\n"
             f"С уважением, твой Фермер.\n\n"
-            f"💰 Баланс: {user.balance}\n"
-            f"⚡ Энергия: {int(user.energy)}"
+            f"💰 Баланс: {game.balance_at(user, now)}\n"
+            f"⚡ Энергия: {int(game.energy_at(user, now))}"
             f"{referral_bonus_text}",
             reply_markup=get_main_keyboard(message.from_user.id)
         )
 
+        if WEB_APP_URL:
+            # Отдельным сообщением: у приветствия уже обычная клавиатура, а initData приходит
+            # только в веб-приложение, открытое из inline-кнопки
+            await message.answer(
+                "🌐 Ферма доступна и в веб-приложении:",
+                reply_markup=InlineKeyboardMarkup(
+                    inline_keyboard=[[
+                        InlineKeyboardButton(text="🌐 Открыть веб-ферму", web_app=WebAppInfo(url=WEB_APP_URL))
+                    ]]
+                ),
+            )
+
 
-@dp.message(F.text == "🛠 Улучшения")
+@menu.text("🛠 Улучшения")
 async def upgrades_menu(message: Message):
-    async with AsyncSessionLocal() as session:
-        result = await session.execute(
-            select(User).where(User.user_id == message.from_user.id)
-        )
-        user = result.scalar_one_or_none()
+    await tap_buffer.settle(message.from_user.id)
 
-        if not user:
-            user = User(user_id=message.from_user.id)
+    user = await user_cache.get(message.from_user.id)
+    if not user:
+        async with AsyncSessionLocal() as session:
+            user = User(
+                user_id=message.from_user.id,
+                username=message.from_user.username,
+                first_name=message.from_user.first_name,
+            )
             session.add(user)
             await session.commit()
+        user_cache.store(user)
 
-        tap_cost = user.tap_power * 100
-        regen_cost = int(user.energy_regen * 200)
-        energy_cost = 200
-        max_energy_cost = user.max_energy * 10
-        auto_farm_cost = (user.auto_farm_level + 1) * 500
+    tap_cost = game.tap_upgrade_cost(user.tap_power)
+    regen_cost = game.regen_upgrade_cost(user.energy_regen)
+    energy_cost = game.ENERGY_PRICE
+    max_energy_cost = game.max_energy_upgrade_cost(user.max_energy)
+    auto_farm_cost = game.auto_farm_upgrade_cost(user.auto_farm_level)
 
     await message.answer(
         "🛠 Меню улучшений\n\n"
@@ -270,32 +374,39 @@ async def upgrades_menu(message: Message):
     )
 
 
-@dp.message(F.text == "🏆 Рейтинг")
+@menu.text("🏆 Рейтинг")
 async def rating_menu(message: Message):
     await message.answer("🏆 Выбери рейтинг", reply_markup=rating_keyboard)
 
 
-@dp.message(F.text == "⬅️ Назад")
+@menu.text("⬅️ Назад")
 async def back_to_main_menu(message: Message):
     await message.answer("⬅️ Главное меню", reply_markup=get_main_keyboard(message.from_user.id))
 
 
-@dp.message(F.text == "👥 Реферальная система")
+@menu.text("👥 Реферальная система")
 async def referral_system(message: Message):
-    async with AsyncSessionLocal() as session:
-        result = await session.execute(
-            select(User).where(User.user_id == message.from_user.id)
-        )
-        user = result.scalar_one_or_none()
+    user = await user_cache.get(message.from_user.id)
+    if not user or not user.referral_code:
+        async with AsyncSessionLocal() as session:
+            result = await session.execute(
+                select(User).where(User.user_id == message.from_user.id)
+            )
+            user = result.scalar_one_or_none()
 
-        if not user:
-            user = User(user_id=message.from_user.id)
-            session.add(user)
+            if not user:
+                user = User(
+                    user_id=message.from_user.id,
+                    username=message.from_user.username,
+                    first_name=message.from_user.first_name,
+                )
+                session.add(user)
 
-        if not user.referral_code:
-            user.referral_code = generate_referral_code(message.from_user.id)
+            if not user.referral_code:
+                user.referral_code = generate_referral_code(message.from_user.id)
 
-        await session.commit()
+            await session.commit()
+        user_cache.store(user)
 
     bot_username = os.getenv("BOT_USERNAME", "").strip().lstrip("@")
     
@@ -334,7 +445,7 @@ async def referral_system(message: Message):
     )
 
 
-@dp.message(F.text == "👑 Панель владельца")
+@menu.text("👑 Панель владельца", flags={"outbound": "admin"})
 async def owner_panel(message: Message):
     if not is_owner(message.from_user.id):
         return
@@ -342,29 +453,15 @@ async def owner_panel(message: Message):
     await message.answer("👑 Панель владельца", reply_markup=owner_keyboard)
 
 
-async def resolve_player_name(user_id: int) -> str:
-    try:
-        chat = await bot.get_chat(user_id)
-    except Exception:
-        return f"id{user_id}"
-
-    if chat.username:
-        return f"@{chat.username}"
-    if chat.first_name:
-        return chat.first_name
-    return f"id{user_id}"
-
-
-async def format_top(users: list[User], value_getter) -> str:
-    filtered_users = [u for u in users if u.user_id != BLOCKED_TOP_USER_ID]
-
-    if not filtered_users:
+async def format_top(entries: list[tuple[int, float]], value_formatter, first_rank: int = 1) -> str:
+    if not entries:
         return "Пока пусто"
 
+    names = await players.resolve_names(bot, [user_id for user_id, _ in entries])
+
     lines = []
-    for i, u in enumerate(filtered_users[:5], start=1):
-        name = await resolve_player_name(u.user_id)
-        lines.append(f"{i}. {name} — {value_getter(u)}")
+    for i, (user_id, value) in enumerate(entries, start=first_rank):
+        lines.append(f"{i}. {names[user_id]} — {value_formatter(value)}")
     return "\n".join(lines)
 
 
@@ -375,79 +472,70 @@ async def get_user_by_target(target: str, session) -> User | None:
     if cleaned.isdigit():
         user_id = int(cleaned)
     else:
-        if not cleaned.startswith("@"):
-            cleaned = f"@{cleaned}"
-        try:
-            chat = await bot.get_chat(cleaned)
-            user_id = chat.id
-        except Exception:
+        user_id = await players.find_user_id(bot, cleaned)
+        if user_id is None:
             return None
 
     result = await session.execute(select(User).where(User.user_id == user_id))
     return result.scalar_one_or_none()
 
 
-@dp.message(Command("paneladmins7623"))
+@dp.message(Command("paneladmins7623"), flags={"outbound": "admin"})
 async def panel_login(message: Message):
     user_id = message.from_user.id
 
     if is_owner(user_id):
-        admin_sessions.add(user_id)
+        await admin_sessions.put(user_id)
         await message.answer("👑 Владелец вошел в админку", reply_markup=admin_keyboard)
-        log_admin_action(user_id, "owner opened admin panel")
+        log_admin_action(user_id, "owner_opened_panel")
         return
 
-    async with AsyncSessionLocal() as session:
-        result = await session.execute(select(User).where(User.user_id == user_id))
-        user = result.scalar_one_or_none()
-
+    user = await user_cache.get(user_id)
     if user and user.admin_rights:
-        admin_sessions.add(user_id)
+        await admin_sessions.put(user_id)
         await message.answer("✅ Вход в админку выполнен", reply_markup=admin_keyboard)
-        log_admin_action(user_id, "admin opened panel by rights")
+        log_admin_action(user_id, "opened_panel")
         return
 
-    pending_password.add(user_id)
+    await menu.set_state(user_id, "password")
     await message.answer("🔐 Введите пароль от админ-панели:")
 
 
-@dp.callback_query(F.data == "owner_open_admin")
+@dp.callback_query(F.data == "owner_open_admin", flags={"outbound": "admin"})
 async def owner_open_admin(callback: CallbackQuery):
     if not is_owner(callback.from_user.id):
         await callback.answer("Нет доступа", show_alert=True)
         return
 
-    admin_sessions.add(callback.from_user.id)
+    await admin_sessions.put(callback.from_user.id)
     await callback.message.answer("🛡 Админка открыта", reply_markup=admin_keyboard)
-    log_admin_action(callback.from_user.id, "owner opened admin panel from owner panel")
+    log_admin_action(callback.from_user.id, "owner_opened_panel")
     await callback.answer()
 
 
-@dp.callback_query(F.data == "owner_grant_admin")
+@dp.callback_query(F.data == "owner_grant_admin", flags={"outbound": "admin"})
 async def owner_grant_admin_start(callback: CallbackQuery):
     if not is_owner(callback.from_user.id):
         await callback.answer("Нет доступа", show_alert=True)
         return
 
-    pending_owner_grant_admin.add(callback.from_user.id)
-    pending_owner_take_admin.discard(callback.from_user.id)
+    await menu.set_state(callback.from_user.id, "owner_grant_admin")
     await callback.message.answer("Введите ID пользователя, которому нужно выдать админку")
     await callback.answer()
 
 
-@dp.callback_query(F.data == "owner_take_admin")
+@dp.callback_query(F.data == "owner_take_admin", flags={"outbound": "admin"})
 async def owner_take_admin_start(callback: CallbackQuery):
     if not is_owner(callback.from_user.id):
         await callback.answer("Нет доступа", show_alert=True)
         return
 
-    pending_owner_take_admin.add(callback.from_user.id)
-    pending_owner_grant_admin.discard(callback.from_user.id)
+    await menu.set_state(callback.from_user.id, "owner_take_admin")
     await callback.message.answer("Введите ID пользователя, у которого нужно забрать админку")
     await callback.answer()
 
 
-@dp.callback_query(F.data == "owner_list_admins")
+@dp.callback_query(F.data == "owner_list_admins", flags={"outbound": "admin"})
 async def owner_list_admins_callback(callback: CallbackQuery):
     if not is_owner(callback.from_user.id):
         await callback.answer("Нет доступа", show_alert=True)
@@ -457,7 +545,7 @@ async def owner_list_admins_callback(callback: CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query(F.data == "owner_actions")
+@dp.callback_query(F.data == "owner_actions", flags={"outbound": "admin"})
 async def owner_actions_callback(callback: CallbackQuery):
     if not is_owner(callback.from_user.id):
         await callback.answer("Нет доступа", show_alert=True)
@@ -467,67 +555,64 @@ async def owner_actions_callback(callback: CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query(F.data == "admin_close")
+@dp.callback_query(F.data == "admin_close", flags={"outbound": "admin"})
 async def admin_close(callback: CallbackQuery):
-    admin_sessions.discard(callback.from_user.id)
-    pending_grant.pop(callback.from_user.id, None)
-    pending_broadcast.discard(callback.from_user.id)
+    await admin_sessions.discard(callback.from_user.id)
+    await menu.clear_state(callback.from_user.id)
     await callback.message.answer("❌ Админка закрыта")
-    log_admin_action(callback.from_user.id, "closed admin panel")
+    log_admin_action(callback.from_user.id, "closed_panel")
     await callback.answer()
 
 
-@dp.callback_query(F.data == "admin_stats")
+@dp.callback_query(F.data == "admin_stats", flags={"outbound": "admin"})
 async def admin_stats(callback: CallbackQuery):
     if not is_admin(callback.from_user.id):
         await callback.answer("Нет доступа", show_alert=True)
         return
 
-    async with AsyncSessionLocal() as session:
-        total_users = await session.scalar(select(func.count()).select_from(User))
-        threshold = datetime.utcnow() - timedelta(minutes=5)
-        online_users = await session.scalar(
-            select(func.count()).select_from(User).where(
-                or_(User.last_energy_update >= threshold, User.last_farm_update >= threshold)
-            )
-        )
+    total_users = await activity.total_users()
+    online_users = await activity.active_count(5 * 60)
+    hourly_users = await activity.active_count(60 * 60)
+    daily_users = await activity.active_count(24 * 60 * 60)
 
     await callback.message.answer(
         f"📊 Статистика бота\n\n"
-        f"👥 Всего пользователей: {total_users or 0}\n"
-        f"🟢 В сети (последние 5 минут): {online_users or 0}",
+        f"👥 Всего пользователей: ~{total_users}\n"
+        f"🟢 В сети (последние 5 минут): {online_users}\n"
+        f"🕐 За час: {hourly_users}\n"
+        f"📅 За сутки: {daily_users}",
         reply_markup=admin_keyboard,
     )
-    log_admin_action(callback.from_user.id, "opened stats")
+    log_admin_action(callback.from_user.id, "opened_stats")
     await callback.answer()
 
 
-@dp.callback_query(F.data.startswith("grant_"))
+@dp.callback_query(F.data.startswith("grant_"), flags={"outbound": "admin"})
 async def admin_grant_select(callback: CallbackQuery):
     if not is_admin(callback.from_user.id):
         await callback.answer("Нет доступа", show_alert=True)
         return
 
     grant_type = callback.data.replace("grant_", "")
-    pending_grant[callback.from_user.id] = {"type": grant_type, "target": None}
+    await menu.set_state(callback.from_user.id, "grant", {"type": grant_type, "target": None})
     await callback.message.answer(
         "Введите ID или @username пользователя для выдачи\n"
         f"Текущий тип выдачи: {grant_type}\n"
         "Для владельца доступно списание: можно ввести отрицательное значение"
     )
-    log_admin_action(callback.from_user.id, f"selected grant type {grant_type}")
+    log_admin_action(callback.from_user.id, "selected_grant", value=grant_type)
     await callback.answer()
 
 
-@dp.callback_query(F.data == "admin_broadcast")
+@dp.callback_query(F.data == "admin_broadcast", flags={"outbound": "admin"})
 async def admin_broadcast_start(callback: CallbackQuery):
     if not is_admin(callback.from_user.id):
         await callback.answer("Нет доступа", show_alert=True)
         return
 
-    pending_broadcast.add(callback.from_user.id)
+    await menu.set_state(callback.from_user.id, "broadcast")
     await callback.message.answer("✉️ Отправьте текст рассылки одним сообщением")
-    log_admin_action(callback.from_user.id, "started broadcast")
+    log_admin_action(callback.from_user.id, "started_broadcast_input")
     await callback.answer()
 
 
@@ -561,10 +646,10 @@ async def back_to_main_from_ref(callback: CallbackQuery):
     await callback.answer()
 
 
-@dp.message(lambda message: message.from_user.id in pending_owner_grant_admin and bool(message.text))
+@menu.input("owner_grant_admin", flags={"outbound": "admin"})
 async def owner_grant_admin_input(message: Message):
     if not is_owner(message.from_user.id):
-        pending_owner_grant_admin.discard(message.from_user.id)
+        await menu.clear_state(message.from_user.id)
         return
 
     raw_id = message.text.strip()
@@ -582,17 +667,18 @@ async def owner_grant_admin_input(message: Message):
 
         target_user.admin_rights = True
         await session.commit()
+    user_cache.store(target_user)
 
-    admin_sessions.add(target_id)
-    pending_owner_grant_admin.discard(message.from_user.id)
-    log_admin_action(message.from_user.id, f"owner granted admin rights to {target_id}")
+    await admin_sessions.put(target_id)
+    await menu.clear_state(message.from_user.id)
+    log_admin_action(message.from_user.id, "granted_admin", target_id)
     await message.answer(f"✅ Админка выдана пользователю {target_id}", reply_markup=owner_keyboard)
 
 
-@dp.message(lambda message: message.from_user.id in pending_owner_take_admin and bool(message.text))
+@menu.input("owner_take_admin", flags={"outbound": "admin"})
 async def owner_take_admin_input(message: Message):
     if not is_owner(message.from_user.id):
-        pending_owner_take_admin.discard(message.from_user.id)
+        await menu.clear_state(message.from_user.id)
         return
 
     raw_id = message.text.strip()
@@ -614,92 +700,86 @@ async def owner_take_admin_input(message: Message):
 
         target_user.admin_rights = False
         await session.commit()
+    user_cache.store(target_user)
 
-    admin_sessions.discard(target_id)
-    pending_password.discard(target_id)
-    pending_grant.pop(target_id, None)
-    pending_broadcast.discard(target_id)
-    pending_owner_take_admin.discard(message.from_user.id)
-    log_admin_action(message.from_user.id, f"owner revoked admin rights from {target_id}")
+    await admin_sessions.discard(target_id)
+    await menu.clear_state(target_id)
+    await menu.clear_state(message.from_user.id)
+    log_admin_action(message.from_user.id, "revoked_admin", target_id)
     await message.answer(f"✅ Админка забрана у пользователя {target_id}", reply_markup=owner_keyboard)
 
 
-@dp.message(lambda message: message.from_user.id in pending_password and bool(message.text))
+@menu.input("password", flags={"outbound": "admin"})
 async def admin_password_input(message: Message):
     user_id = message.from_user.id
     text_value = message.text.strip()
 
-    pending_password.discard(user_id)
+    await menu.clear_state(user_id)
     if text_value == ADMIN_PANEL_PASSWORD:
-        admin_sessions.add(user_id)
+        await admin_sessions.put(user_id)
 
         async with AsyncSessionLocal() as session:
             result = await session.execute(select(User).where(User.user_id == user_id))
             user = result.scalar_one_or_none()
             if user is None:
-                user = User(user_id=user_id)
+                user = User(
+                    user_id=user_id,
+                    username=message.from_user.username,
+                    first_name=message.from_user.first_name,
+                )
                 session.add(user)
             user.admin_rights = True
             await session.commit()
+        user_cache.store(user)
 
-        log_admin_action(user_id, "logged into admin panel")
+        log_admin_action(user_id, "logged_in")
         await message.answer("✅ Доступ выдан", reply_markup=admin_keyboard)
     else:
         await message.answer("❌ Неверный пароль")
 
 
-@dp.message(lambda message: message.from_user.id in pending_broadcast and bool(message.text))
+@menu.input("broadcast", flags={"outbound": "admin"})
 async def admin_broadcast_message(message: Message):
     user_id = message.from_user.id
 
     if not is_admin(user_id):
-        pending_broadcast.discard(user_id)
+        await menu.clear_state(user_id)
         await message.answer("❌ Доступ к админке потерян")
         return
 
-    pending_broadcast.discard(user_id)
-    async with AsyncSessionLocal() as session:
-        result = await session.execute(select(User.user_id))
-        user_ids = result.scalars().all()
-
-    sent = 0
-    failed = 0
-    for uid in user_ids:
-        try:
-            await bot.send_message(uid, message.text)
-            sent += 1
-        except Exception:
-            failed += 1
+    await menu.clear_state(user_id)
+    job_id = await broadcast.start(
+        bot, user_id, message.text, message.chat.id, on_finish=log_broadcast_finished
+    )
 
-    log_admin_action(user_id, f"broadcast sent: delivered={sent}, failed={failed}")
+    log_admin_action(user_id, "broadcast_started", value=f"#{job_id}")
     await message.answer(
-        f"✅ Рассылка завершена\n"
-        f"Доставлено: {sent}\n"
-        f"Не доставлено: {failed}",
+        f"📣 Рассылка #{job_id} запущена\n"
+        "Прогресс обновляется в сообщении выше",
         reply_markup=admin_keyboard,
     )
 
 
-@dp.message(lambda message: message.from_user.id in pending_grant and bool(message.text))
+@menu.input("grant", flags={"outbound": "admin"})
 async def admin_grant_input(message: Message):
     user_id = message.from_user.id
     text = message.text.strip()
 
     if not is_admin(user_id):
-        pending_grant.pop(user_id, None)
+        await menu.clear_state(user_id)
         await message.answer("❌ Доступ к админке потерян")
         return
 
-    grant_data = pending_grant[user_id]
+    grant_data = menu.get_state(user_id)
     grant_type = grant_data["type"]
 
     if text.lower() == "отмена":
-        pending_grant.pop(user_id, None)
+        await menu.clear_state(user_id)
         await message.answer("❌ Выдача отменена", reply_markup=admin_keyboard)
         return
 
     if grant_data["target"] is None:
-        grant_data["target"] = text
+        await menu.set_state(user_id, "grant", {"type": grant_type, "target": text})
         await message.answer("Теперь введите значение для выдачи (например: 100)")
         return
 
@@ -725,6 +805,10 @@ async def admin_grant_input(message: Message):
             await message.answer("❌ Пользователь не найден в базе")
             return
 
+        await tap_buffer.settle(target_user.user_id)
+        await session.refresh(target_user, with_for_update=True)
+
+        farm_earned = game.settle(target_user)
         if grant_type == "balance":
             target_user.balance += int(value)
             result_text = f"Баланс {int(value):+d}"
@@ -748,21 +832,49 @@ async def admin_grant_input(message: Message):
             return
 
         await session.commit()
-
-    pending_grant.pop(user_id, None)
-    log_admin_action(user_id, f"grant {grant_type} {value} to {target_user.user_id}")
+    user_cache.store(target_user)
+
+    ledger.record(target_user.user_id, farm_earned, "farm")
+    if grant_type == "balance":
+        ledger.record(target_user.user_id, int(value), "grant")
+    leaderboard.observe("balance", target_user.user_id, target_user.balance)
+    leaderboard.observe("auto_farm", target_user.user_id, target_user.auto_farm_level)
+    leaderboard.observe("regen", target_user.user_id, target_user.energy_regen)
+    await menu.clear_state(user_id)
+    log_admin_action(user_id, f"grant_{grant_type}", target_user.user_id, value)
     await message.answer(f"✅ Готово: {result_text}", reply_markup=admin_keyboard)
 
 
-@dp.message(Command("adminactions7623"))
+@dp.message(Command("adminactions7623"), flags={"outbound": "admin"})
 async def owner_admin_actions(message: Message):
     if not is_owner(message.from_user.id):
         return
 
-    await send_admin_actions_message(message)
+    filters = parse_admin_actions_filters((message.text or "").split()[1:])
+    await send_admin_actions_message(message, **filters)
 
 
-@dp.message(Command("adminslist7623"))
+@dp.callback_query(F.data.startswith("audit:"), flags={"outbound": "admin"})
+async def admin_actions_page(callback: CallbackQuery):
+    if not is_owner(callback.from_user.id):
+        await callback.answer("Нет доступа", show_alert=True)
+        return
+
+    actor_id, target_id, since, before_id = (
+        int(value) if value else None for value in callback.data.split(":")[1:5]
+    )
+    await send_admin_actions_message(
+        callback.message,
+        actor_id=actor_id,
+        target_id=target_id,
+        since=since,
+        before_id=before_id,
+        edit=True,
+    )
+    await callback.answer()
+
+
+@dp.message(Command("adminslist7623"), flags={"outbound": "admin"})
 async def owner_admin_list(message: Message):
     if not is_owner(message.from_user.id):
         return
@@ -770,7 +882,58 @@ async def owner_admin_list(message: Message):
     await send_admin_list_message(message)
 
 
-@dp.message(Command("takeadmin7623"))
+@dp.message(Command("throttle7623"), flags={"outbound": "admin"})
+async def owner_throttle_stats(message: Message):
+    if not is_owner(message.from_user.id):
+        return
+
+    offenders = throttling.top_throttled()
+    if not offenders:
+        await message.answer("🚦 Никто не упирался в лимиты")
+        return
+
+    lines = [
+        f"• {user_id}: отсечено {state.throttled}, пропущено {state.allowed}"
+        for user_id, state in offenders
+    ]
+    await message.answer("🚦 Кто чаще всех упирается в лимиты:\n\n" + "\n".join(lines))
+
+
+@dp.message(Command("pool7623"), flags={"outbound": "admin"})
+async def owner_pool_stats(message: Message):
+    if not is_owner(message.from_user.id):
+        return
+
+    stats = pool_stats()
+    cache = user_cache.stats()
+    replica_stats = replica.stats()
+    if not replica_stats["configured"]:
+        replica_text = "не задана"
+    elif replica_stats["available"]:
+        replica_text = f"в работе, отставание {replica_stats['lag_seconds']:.1f} сек"
+    elif replica_stats["lag_seconds"] is None:
+        replica_text = "недоступна, читаем с основной базы"
+    else:
+        replica_text = f"отстала на {replica_stats['lag_seconds']:.1f} сек, читаем с основной базы"
+    histogram = "\n".join(f"  {bucket}: {count}" for bucket, count in stats["wait_histogram"].items())
+    await message.answer(
+        "🗄 Пул соединений с базой\n\n"
+        f"Размер: {stats['size']}\n"
+        f"Занято: {stats['checked_out']}\n"
+        f"Свободно: {stats['checked_in']}\n"
+        f"Сверх размера: {stats['overflow']} из {stats['max_overflow']}\n"
+        f"Таймаутов ожидания: {stats['timeouts']}\n\n"
+        f"Ожидание соединения:\n{histogram}\n\n"
+        f"👤 Кэш игроков: {cache['size']} из {cache['capacity']}\n"
+        f"Попаданий: {cache['hits']}, промахов: {cache['misses']} ({cache['hit_rate']:.0%})\n"
+        f"Вытеснено: {cache['evictions']}\n\n"
+        f"📖 Реплика для чтения: {replica_text}\n"
+        f"Чтений с реплики: {replica_stats['reads']['replica']}, с основной базы: {replica_stats['reads']['primary']}\n"
+        f"Повторено в основной базе после ошибки реплики: {replica_stats['reads']['fallback']}"
+    )
+
+
+@dp.message(Command("takeadmin7623"), flags={"outbound": "admin"})
 async def owner_take_admin(message: Message):
     if not is_owner(message.from_user.id):
         return
@@ -794,236 +957,456 @@ async def owner_take_admin(message: Message):
 
         target_user.admin_rights = False
         await session.commit()
+    user_cache.store(target_user)
 
-    admin_sessions.discard(target_user.user_id)
-    pending_password.discard(target_user.user_id)
-    pending_grant.pop(target_user.user_id, None)
-    pending_broadcast.discard(target_user.user_id)
+    await admin_sessions.discard(target_user.user_id)
+    await menu.clear_state(target_user.user_id)
 
-    log_admin_action(message.from_user.id, f"revoked admin rights from {target_user.user_id}")
+    log_admin_action(message.from_user.id, "revoked_admin", target_user.user_id)
     await message.answer(f"✅ Админка забрана у {target_user.user_id}")
 
 
-@dp.message(F.text == "💰 Топ по балансу")
-async def top_balance(message: Message):
+@dp.message(Command("ledger7623"), flags={"outbound": "admin"})
+async def owner_ledger(message: Message):
+    if not is_owner(message.from_user.id):
+        return
+
+    parts = (message.text or "").split(maxsplit=1)
+    if len(parts) < 2:
+        await message.answer("Формат: /ledger7623 <id или @username>")
+        return
+
     async with AsyncSessionLocal() as session:
-        result = await session.execute(select(User).order_by(desc(User.balance)).limit(10))
-        users = result.scalars().all()
+        target_user = await get_user_by_target(parts[1].strip(), session)
+    if not target_user:
+        await message.answer("❌ Пользователь не найден в базе")
+        return
 
-    top_text = await format_top(users, lambda u: f"{u.balance}💰")
-    await message.answer(f"💰 Топ-5 по балансу\n\n{top_text}", reply_markup=rating_keyboard)
+    entries = await ledger.history(target_user.user_id)
+    if not entries:
+        await message.answer(f"📜 У {target_user.user_id} пока нет движений по балансу")
+        return
 
+    lines = [f"[{entry.created_at:%Y-%m-%d %H:%M:%S}] {entry.delta:+d} {entry.reason}" for entry in entries]
+    await message.answer(
+        f"📜 Баланс {target_user.user_id}: {target_user.balance}\n"
+        f"Последние движения:\n\n" + "\n".join(lines)
+    )
 
-@dp.message(F.text == "🤖 Топ по авто-фарму")
-async def top_auto_farm(message: Message):
-    async with AsyncSessionLocal() as session:
-        result = await session.execute(select(User).order_by(desc(User.auto_farm_level)).limit(10))
-        users = result.scalars().all()
 
-    top_text = await format_top(users, lambda u: f"{u.auto_farm_level}/сек")
-    await message.answer(f"🤖 Топ-5 по авто-фарму\n\n{top_text}", reply_markup=rating_keyboard)
+# -------- РЕЙТИНГ --------
+TOPS = {
+    "balance": ("💰 Топ по балансу", lambda value: f"{value}💰"),
+    "auto_farm": ("🤖 Топ по авто-фарму", lambda value: f"{value}/сек"),
+    "regen": ("🚀 Топ по регену", lambda value: f"{value}/сек"),
+}
+
+
+async def format_my_rank(metric: str, user_id: int) -> str:
+    # Своё значение берём из кэша игрока, место — ограниченным подсчётом по индексу или оценкой
+    user = await user_cache.get(user_id)
+    if user is None:
+        return ""
+
+    value = getattr(user, leaderboard.METRICS[metric].key)
+    place, exact = await leaderboard.rank(metric, user_id, value)
+    return f"\n\n📍 Твоё место: {place}" if exact else f"\n\n📍 Твоё место: ≈{place}"
+
+
+async def send_top_page(
+    message: Message,
+    user_id: int,
+    metric: str,
+    entries: list[tuple[int, float]],
+    first_rank: int,
+    has_more: bool,
+    edit: bool = False,
+):
+    title, value_formatter = TOPS[metric]
+    top_text = await format_top(entries, value_formatter, first_rank)
+    text = f"{title}\n\n{top_text}{await format_my_rank(metric, user_id)}"
+
+    # В callback_data место и ключ крайней строки: соседняя страница продолжается от неё по индексу
+    buttons = []
+    if entries and first_rank > 1:
+        anchor_id, value = entries[0]
+        buttons.append(InlineKeyboardButton(
+            text="⬅️ Выше",
+            callback_data=f"top:{metric}:p:{first_rank}:{value}:{anchor_id}",
+        ))
+    if entries and has_more:
+        anchor_id, value = entries[-1]
+        buttons.append(InlineKeyboardButton(
+            text="Ниже ➡️",
+            callback_data=f"top:{metric}:n:{first_rank + len(entries) - 1}:{value}:{anchor_id}",
+        ))
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+
+    if edit:
+        await message.edit_text(text, reply_markup=keyboard)
+    else:
+        await message.answer(text, reply_markup=keyboard)
 
 
-@dp.message(F.text == "🚀 Топ по регену")
+async def send_top(message: Message, metric: str):
+    # Первая страница — из закэшированного топа
+    entries = await leaderboard.get_top(metric)
+    has_more = len(entries) >= leaderboard.LEADERBOARD_SIZE
+    await send_top_page(message, message.from_user.id, metric, entries, 1, has_more)
+
+
+@menu.text("💰 Топ по балансу")
+async def top_balance(message: Message):
+    await send_top(message, "balance")
+
+
+@menu.text("🤖 Топ по авто-фарму")
+async def top_auto_farm(message: Message):
+    await send_top(message, "auto_farm")
+
+
+@menu.text("🚀 Топ по регену")
 async def top_regen(message: Message):
-    async with AsyncSessionLocal() as session:
-        result = await session.execute(select(User).order_by(desc(User.energy_regen)).limit(10))
-        users = result.scalars().all()
+    await send_top(message, "regen")
 
-    top_text = await format_top(users, lambda u: f"{u.energy_regen}/сек")
-    await message.answer(f"🚀 Топ-5 по регену\n\n{top_text}", reply_markup=rating_keyboard)
 
+@dp.callback_query(F.data.startswith("top:"))
+async def top_page(callback: CallbackQuery):
+    _, metric, direction, rank, value, anchor_id = callback.data.split(":")
+    if metric not in TOPS or callback.message is None:
+        await callback.answer()
+        return
 
-# -------- ТАП --------
-@dp.message(F.text == "👇 Тап")
-async def tap_handler(message: Message):
-    async with AsyncSessionLocal() as session:
-        result = await session.execute(
-            select(User).where(User.user_id == message.from_user.id)
-        )
-        user = result.scalar_one()
+    rank = int(rank)
+    value = leaderboard.parse_value(metric, value)
+    if direction == "n":
+        entries, has_more = await leaderboard.page_after(metric, value, int(anchor_id))
+        first_rank = rank + 1
+    else:
+        entries = await leaderboard.page_before(metric, value, int(anchor_id))
+        has_more = True
+        # Неполная страница вверх — значит, дошли до начала рейтинга
+        first_rank = 1 if len(entries) < leaderboard.LEADERBOARD_SIZE else max(1, rank - len(entries))
+
+    if not entries:
+        await callback.answer("Дальше никого нет")
+        return
+
+    await send_top_page(callback.message, callback.from_user.id, metric, entries, first_rank, has_more, edit=True)
+    await callback.answer()
 
-        await update_energy(user)
-        await update_auto_farm(user)
 
-        if user.energy < user.tap_power:
+# -------- ТАП --------
+@menu.text("👇 Тап", flags={"throttle": "tap"})
+async def tap_handler(message: Message, tap_count: int = 1):
+    if tap_buffer.TAP_WRITE_BEHIND:
+        state, tapped = await tap_buffer.tap(message.from_user.id, tap_count)
+        if state is None:
+            return
+
+        if not tapped:
             await message.answer("❌ Нет энергии!")
             return
 
-        user.energy -= user.tap_power
-        user.balance += user.tap_power
+        leaderboard.observe("balance", message.from_user.id, state.balance)
+        with outbound.coalesce("tap"):
+            await message.answer(
+                f"💰 Баланс: {state.balance}\n"
+                f"⚡ Энергия: {int(state.energy)}"
+            )
+        return
 
-        await session.commit()
+    row, tapped = await game.tap(message.from_user.id, tap_count)
+    if row is None:
+        return
+
+    if not tapped:
+        await message.answer("❌ Нет энергии!")
+        return
 
+    leaderboard.observe("balance", row.user_id, row.balance)
+    # Если прошлый ответ ещё ждёт очереди в этом чате, игрок увидит только свежий баланс
+    with outbound.coalesce("tap"):
         await message.answer(
-            f"💰 Баланс: {user.balance}\n"
-            f"⚡ Энергия: {int(user.energy)}"
+            f"💰 Баланс: {row.balance}\n"
+            f"⚡ Энергия: {int(row.energy)}"
         )
 
 
+def format_tap_panel(balance: int, energy: float, tapped: bool = True) -> str:
+    text = f"💰 Баланс: {balance}\n⚡ Энергия: {int(energy)}"
+    if not tapped:
+        text += "\n\n❌ Нет энергии!"
+    return text
+
+
+@menu.text("🎯 Тап-панель")
+async def open_tap_panel(message: Message):
+    await tap_buffer.settle(message.from_user.id)
+
+    user = await user_cache.get(message.from_user.id)
+    if user is None:
+        return
+
+    now = datetime.utcnow()
+    await message.answer(
+        format_tap_panel(game.balance_at(user, now), game.energy_at(user, now)),
+        reply_markup=tap_panel_keyboard,
+    )
+
+
+@dp.callback_query(F.data == "tap", flags={"throttle": "tap"})
+async def tap_panel_handler(callback: CallbackQuery, tap_count: int = 1):
+    # Отвечаем сразу, а сообщение с балансом правится не чаще раза в TAP_PANEL_EDIT_INTERVAL_MS
+    await callback.answer()
+    if callback.message is None:
+        return
+
+    if tap_buffer.TAP_WRITE_BEHIND:
+        state, tapped = await tap_buffer.tap(callback.from_user.id, tap_count)
+    else:
+        state, tapped = await game.tap(callback.from_user.id, tap_count)
+    if state is None:
+        return
+
+    if tapped:
+        leaderboard.observe("balance", callback.from_user.id, state.balance)
+    tap_panel.show(
+        bot,
+        callback.from_user.id,
+        callback.message,
+        format_tap_panel(state.balance, state.energy, tapped),
+        tap_panel_keyboard,
+    )
+
+
 # -------- УЛУЧШЕНИЯ --------
-@dp.message(F.text == "⚡ Улучшить тап")
+@menu.text("⚡ Улучшить тап", flags={"throttle": "upgrade"})
 async def upgrade_tap(message: Message):
-    async with AsyncSessionLocal() as session:
-        result = await session.execute(
-            select(User).where(User.user_id == message.from_user.id)
-        )
-        user = result.scalar_one()
+    await tap_buffer.settle(message.from_user.id)
 
-        cost = user.tap_power * 100
-
-        if user.balance < cost:
-            await message.answer("❌ Недостаточно денег!")
-            return
+    row, upgraded = await game.upgrade_tap(message.from_user.id)
+    if row is None:
+        return
 
-        user.balance -= cost
-        user.tap_power += 1
-        await session.commit()
+    if not upgraded:
+        await message.answer("❌ Недостаточно денег!")
+        return
 
-        await message.answer(f"✅ Tap power теперь: {user.tap_power}\n💸 Стоимость улучшения: {cost} монет")
+    leaderboard.observe("balance", row.user_id, row.balance)
+    cost = game.tap_upgrade_cost(row.tap_power - 1)
+    await message.answer(f"✅ Tap power теперь: {row.tap_power}\n💸 Стоимость улучшения: {cost} монет")
 
 
-@dp.message(F.text == "🚀 Улучшить реген")
+@menu.text("🚀 Улучшить реген", flags={"throttle": "upgrade"})
 async def upgrade_regen(message: Message):
-    async with AsyncSessionLocal() as session:
-        result = await session.execute(
-            select(User).where(User.user_id == message.from_user.id)
-        )
-        user = result.scalar_one()
+    await tap_buffer.settle(message.from_user.id)
 
-        cost = int(user.energy_regen * 200)
-
-        if user.balance < cost:
-            await message.answer("❌ Недостаточно денег!")
-            return
+    row, upgraded = await game.upgrade_regen(message.from_user.id)
+    if row is None:
+        return
 
-        user.balance -= cost
-        user.energy_regen += 0.5
-        await session.commit()
+    if not upgraded:
+        await message.answer("❌ Недостаточно денег!")
+        return
 
-        await message.answer(f"✅ Реген теперь: {user.energy_regen}/сек\n💸 Стоимость улучшения: {cost} монет")
+    leaderboard.observe("balance", row.user_id, row.balance)
+    leaderboard.observe("regen", row.user_id, row.energy_regen)
+    cost = game.regen_upgrade_cost(row.energy_regen - game.REGEN_STEP)
+    await message.answer(f"✅ Реген теперь: {row.energy_regen}/сек\n💸 Стоимость улучшения: {cost} монет")
 
 
-@dp.message(F.text == "💵 Купить энергию")
+@menu.text("💵 Купить энергию", flags={"throttle": "upgrade"})
 async def buy_energy(message: Message):
-    async with AsyncSessionLocal() as session:
-        result = await session.execute(
-            select(User).where(User.user_id == message.from_user.id)
-        )
-        user = result.scalar_one()
-
-        cost = 200
+    await tap_buffer.settle(message.from_user.id)
 
-        if user.balance < cost:
-            await message.answer("❌ Недостаточно денег!")
-            return
+    row, bought = await game.buy_energy(message.from_user.id)
+    if row is None:
+        return
 
-        user.balance -= cost
-        user.energy = user.max_energy
-        await session.commit()
+    if not bought:
+        await message.answer("❌ Недостаточно денег!")
+        return
 
-        await message.answer(f"✅ Энергия восстановлена!\n💸 Стоимость: {cost} монет")
+    leaderboard.observe("balance", row.user_id, row.balance)
+    await message.answer(f"✅ Энергия восстановлена!\n💸 Стоимость: {game.ENERGY_PRICE} монет")
 
 
-@dp.message(F.text == "🔋 Увеличить макс. энергию")
+@menu.text("🔋 Увеличить макс. энергию", flags={"throttle": "upgrade"})
 async def upgrade_max_energy(message: Message):
-    async with AsyncSessionLocal() as session:
-        result = await session.execute(
-            select(User).where(User.user_id == message.from_user.id)
-        )
-        user = result.scalar_one()
-
-        cost = user.max_energy * 10
+    await tap_buffer.settle(message.from_user.id)
 
-        if user.balance < cost:
-            await message.answer(f"❌ Недостаточно денег! Нужно {cost} монет")
-            return
+    row, upgraded = await game.upgrade_max_energy(message.from_user.id)
+    if row is None:
+        return
 
-        user.balance -= cost
-        user.max_energy += 25
-        user.energy = min(user.max_energy, user.energy + 25)
-        await session.commit()
+    if not upgraded:
+        cost = game.max_energy_upgrade_cost(row.max_energy)
+        await message.answer(f"❌ Недостаточно денег! Нужно {cost} монет")
+        return
 
-        await message.answer(
-            f"✅ Макс. энергия теперь: {user.max_energy}\n"
-            f"⚡ Текущая энергия: {int(user.energy)}\n"
-            f"💸 Стоимость улучшения: {cost} монет"
-        )
+    leaderboard.observe("balance", row.user_id, row.balance)
+    cost = game.max_energy_upgrade_cost(row.max_energy - game.MAX_ENERGY_STEP)
+    await message.answer(
+        f"✅ Макс. энергия теперь: {row.max_energy}\n"
+        f"⚡ Текущая энергия: {int(row.energy)}\n"
+        f"💸 Стоимость улучшения: {cost} монет"
+    )
 
 
-@dp.message(F.text == "🤖 Авто-фарм")
+@menu.text("🤖 Авто-фарм", flags={"throttle": "upgrade"})
 async def auto_farm(message: Message):
-    async with AsyncSessionLocal() as session:
-        result = await session.execute(
-            select(User).where(User.user_id == message.from_user.id)
-        )
-        user = result.scalar_one()
+    await tap_buffer.settle(message.from_user.id)
 
-        cost = (user.auto_farm_level + 1) * 500
+    row, upgraded = await game.upgrade_auto_farm(message.from_user.id)
+    if row is None:
+        return
 
-        if user.balance < cost:
-            await message.answer(f"❌ Нужно {cost} монет")
-            return
+    if not upgraded:
+        cost = game.auto_farm_upgrade_cost(row.auto_farm_level)
+        await message.answer(f"❌ Нужно {cost} монет")
+        return
 
-        user.balance -= cost
-        user.auto_farm_level += 1
-        user.auto_farm_enabled = True
+    leaderboard.observe("balance", row.user_id, row.balance)
+    leaderboard.observe("auto_farm", row.user_id, row.auto_farm_level)
+    cost = game.auto_farm_upgrade_cost(row.auto_farm_level - 1)
+    await message.answer(
+        f"✅ Авто-фарм уровень: {row.auto_farm_level}\n"
+        f"Фармит {row.auto_farm_level} монет/сек\n"
+        f"💸 Стоимость улучшения: {cost} монет"
+    )
 
-        await session.commit()
 
-        await message.answer(
-            f"✅ Авто-фарм уровень: {user.auto_farm_level}\n"
-            f"Фармит {user.auto_farm_level} монет/сек\n"
-            f"💸 Стоимость улучшения: {cost} монет"
+# -------- ОПТОВЫЕ ПОКУПКИ --------
+BULK_COUNT = 10
+
+# Вид улучшения: название, покупка, цена следующего уровня, шаг цены
+BULK_UPGRADES = {
+    "tap": ("⚡ Тап", game.upgrade_tap, lambda user: game.tap_upgrade_cost(user.tap_power), game.TAP_COST_STEP),
+    "regen": ("🚀 Реген", game.upgrade_regen, lambda user: game.regen_upgrade_cost(user.energy_regen), game.REGEN_COST_STEP),
+    "max_energy": ("🔋 Макс. энергия", game.upgrade_max_energy, lambda user: game.max_energy_upgrade_cost(user.max_energy), game.MAX_ENERGY_COST_STEP),
+    "auto_farm": ("🤖 Авто-фарм", game.upgrade_auto_farm, lambda user: game.auto_farm_upgrade_cost(user.auto_farm_level), game.AUTO_FARM_COST_STEP),
+}
+
+
+def format_bulk_upgrades(user, now: datetime) -> tuple[str, InlineKeyboardMarkup]:
+    # Сколько уровней по карману, считается формулой, а не перебором покупок
+    balance = game.balance_at(user, now)
+    lines = [f"📦 Купить оптом\n💰 Баланс: {balance}\n"]
+    rows = []
+    for kind, (title, _, next_cost, step) in BULK_UPGRADES.items():
+        first = next_cost(user)
+        levels = game.affordable_levels(first, step, balance)
+        lines.append(
+            f"{title}: ×{BULK_COUNT} — {game.series_cost(first, step, BULK_COUNT)} монет, "
+            f"хватит на ×{levels} за {game.series_cost(first, step, levels)}"
         )
+        rows.append([
+            InlineKeyboardButton(text=f"{title} ×{BULK_COUNT}", callback_data=f"bulk:{kind}:{BULK_COUNT}"),
+            InlineKeyboardButton(text=f"Макс. ×{levels}", callback_data=f"bulk:{kind}:max"),
+        ])
+    return "\n".join(lines), InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+@menu.text("📦 Купить оптом")
+async def bulk_upgrades_menu(message: Message):
+    await tap_buffer.settle(message.from_user.id)
+
+    user = await user_cache.get(message.from_user.id)
+    if user is None:
+        return
+
+    text, keyboard = format_bulk_upgrades(user, datetime.utcnow())
+    await message.answer(text, reply_markup=keyboard)
 
 
-@dp.message(F.text == "📊 Профиль")
+@dp.callback_query(F.data.startswith("bulk:"), flags={"throttle": "upgrade"})
+async def bulk_upgrade(callback: CallbackQuery):
+    kind, _, count = callback.data.removeprefix("bulk:").partition(":")
+    upgrade = BULK_UPGRADES.get(kind)
+    # callback_data присылает клиент: принимаем только то, что показывают кнопки
+    if upgrade is None or count not in (str(BULK_COUNT), "max") or callback.message is None:
+        await callback.answer()
+        return
+
+    # Любое число уровней — одна транзакция и одно сообщение вместо сотен нажатий
+    await tap_buffer.settle(callback.from_user.id)
+    row, levels = await upgrade[1](callback.from_user.id, None if count == "max" else int(count))
+    if row is None:
+        await callback.answer()
+        return
+
+    if not levels:
+        await callback.answer("❌ Недостаточно денег!", show_alert=True)
+        return
+
+    leaderboard.observe("balance", row.user_id, row.balance)
+    if kind == "regen":
+        leaderboard.observe("regen", row.user_id, row.energy_regen)
+    elif kind == "auto_farm":
+        leaderboard.observe("auto_farm", row.user_id, row.auto_farm_level)
+
+    spent = row.farm_delta - row.balance_delta
+    await callback.answer(f"✅ Куплено уровней: {levels}\n💸 Потрачено: {spent} монет")
+    text, keyboard = format_bulk_upgrades(row, datetime.utcnow())
+    await callback.message.edit_text(text, reply_markup=keyboard)
+
+
+@menu.text("📊 Профиль")
 async def profile(message: Message):
-    async with AsyncSessionLocal() as session:
-        result = await session.execute(
-            select(User).where(User.user_id == message.from_user.id)
-        )
-        user = result.scalar_one()
+    await tap_buffer.settle(message.from_user.id)
 
-        await update_energy(user)
-        await update_auto_farm(user)
-        await session.commit()
+    # Энергия и доход авто-фарма считаются при чтении, профиль ничего не пишет в базу
+    # и для активного игрока обходится без запроса — якоря берутся из кэша
+    user = await user_cache.get(message.from_user.id)
+    if user is None:
+        return
 
-        await message.answer(
-            f"📊 Профиль\n\n"
-            f"💰 Баланс: {user.balance}\n"
-            f"⚡ Энергия: {int(user.energy)}\n"
-            f"⚡ Tap power: {user.tap_power}\n"
-            f"🚀 Реген: {user.energy_regen}/сек\n"
-            f"🤖 Авто-фарм: {user.auto_farm_level}/сек"
-        )
+    now = datetime.utcnow()
+    await message.answer(
+        f"📊 Профиль\n\n"
+        f"💰 Баланс: {game.balance_at(user, now)}\n"
+        f"⚡ Энергия: {int(game.energy_at(user, now))}\n"
+        f"⚡ Tap power: {user.tap_power}\n"
+        f"🚀 Реген: {user.energy_regen}/сек\n"
+        f"🤖 Авто-фарм: {user.auto_farm_level}/сек"
+    )
 
 
 async def main():
-    from database import Base, engine
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
-        await conn.execute(
-            text("ALTER TABLE users ADD COLUMN IF NOT EXISTS admin_rights BOOLEAN DEFAULT FALSE")
-        )
-        await conn.execute(
-            text("ALTER TABLE users ADD COLUMN IF NOT EXISTS invited_by BIGINT")
-        )
-        await conn.execute(
-            text("ALTER TABLE users ADD COLUMN IF NOT EXISTS referral_code TEXT")
-        )
-        await conn.execute(
-            text("ALTER TABLE users ADD COLUMN IF NOT EXISTS referrals_count INTEGER DEFAULT 0")
-        )
-        await conn.execute(
-            text("ALTER TABLE users ADD COLUMN IF NOT EXISTS referral_earned INTEGER DEFAULT 0")
-        )
-        await conn.execute(
-            text("CREATE UNIQUE INDEX IF NOT EXISTS idx_users_referral_code_unique ON users (referral_code)")
-        )
-
-    await dp.start_polling(bot)
+    await migrations.migrate()
+    await warm_up_pool()
+    await replica.start()
+    await state_store.store.start()
+    await tap_buffer.start()
+    await activity.start()
+    await audit.start()
+    await ledger.start()
+    await user_cache.start()
+    await farm_settlement.start()
+    await broadcast.resume(bot, on_finish=log_broadcast_finished)
+    try:
+        if BOT_MODE == "webhook":
+            await webhook.run(dp, bot)
+        else:
+            metrics_runner = await metrics.serve()
+            try:
+                await dp.start_polling(bot)
+            finally:
+                if metrics_runner is not None:
+                    await metrics_runner.cleanup()
+    finally:
+        await activity.stop()
+        await audit.stop()
+        # Последние записи тапов, фарма и отправок пишут в журнал баланса и объявляют изменения в кэше —
+        # журнал и кэш останавливаем после них
+        await tap_buffer.stop()
+        await farm_settlement.stop()
+        await outbound.stop()
+        await ledger.stop()
+        await user_cache.stop()
+        await state_store.store.stop()
+        await replica.stop()
 
 
 if __name__ == "__main__":
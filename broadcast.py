@@ -0,0 +1,210 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+from sqlalchemy import select, text, update
+
+import outbound
+from database import AsyncSessionLocal, BroadcastJob, User, engine
+from replica import read_session
+from ratelimit import TokenBucket
+
+
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "8"))
+BROADCAST_CHUNK = 500
+BROADCAST_PROGRESS_INTERVAL = 5
+BROADCAST_LOCK_NAMESPACE = 5001
+
+logger = logging.getLogger(__name__)
+
+_bucket = TokenBucket(BROADCAST_RATE, BROADCAST_RATE)
+_tasks: dict[int, asyncio.Task] = {}
+
+
+def format_progress(job_id: int, counters: dict[str, int], finished: bool) -> str:
+    status = "✅ Рассылка завершена" if finished else "⏳ Рассылка идёт"
+    return (
+        f"📣 Рассылка #{job_id}\n"
+        f"{status}\n\n"
+        f"Доставлено: {counters['sent']}\n"
+        f"Не доставлено: {counters['failed']}\n"
+        f"Заблокировали бота: {counters['blocked']}"
+    )
+
+
+async def _send(bot: Bot, user_id: int, text: str) -> str:
+    while True:
+        await _bucket.acquire()
+        try:
+            await bot.send_message(user_id, text)
+            return "sent"
+        except TelegramRetryAfter as e:
+            _bucket.pause(e.retry_after)
+        except TelegramForbiddenError:
+            return "blocked"
+        except Exception:
+            return "failed"
+
+
+async def _checkpoint(job_id: int, last_user_id: int, counters: dict[str, int], blocked_ids: list[int]):
+    async with AsyncSessionLocal() as session:
+        await session.execute(
+            update(BroadcastJob)
+            .where(BroadcastJob.id == job_id)
+            .values(last_user_id=last_user_id, **counters)
+        )
+        if blocked_ids:
+            await session.execute(
+                update(User).where(User.user_id.in_(blocked_ids)).values(bot_blocked=True)
+            )
+        await session.commit()
+
+
+async def _report_progress(bot: Bot, job: BroadcastJob, counters: dict[str, int]):
+    last_text = None
+    while True:
+        await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+        progress_text = format_progress(job.id, counters, finished=False)
+        if progress_text == last_text:
+            continue
+        try:
+            with outbound.priority("admin"):
+                await bot.edit_message_text(progress_text, chat_id=job.chat_id, message_id=job.message_id)
+            last_text = progress_text
+        except Exception:
+            logger.warning("Failed to update broadcast #%s progress", job.id, exc_info=True)
+
+
+async def _run(bot: Bot, job_id: int, on_finish):
+    # При нескольких репликах рассылку ведёт та, что взяла блокировку. Блокировка сессионная
+    # на отдельном соединении в autocommit: транзакция на основной базе всё время прохода не висит
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        lock = {"namespace": BROADCAST_LOCK_NAMESPACE, "job_id": job_id}
+        if not await conn.scalar(text("SELECT pg_try_advisory_lock(:namespace, :job_id)"), lock):
+            return
+        try:
+            job, counters = await _broadcast(bot, job_id)
+        finally:
+            await conn.execute(text("SELECT pg_advisory_unlock(:namespace, :job_id)"), lock)
+
+    if job is not None and on_finish is not None:
+        on_finish(job, counters)
+
+
+async def _broadcast(bot: Bot, job_id: int):
+    async with AsyncSessionLocal() as session:
+        job = await session.get(BroadcastJob, job_id)
+    # Пока ждали блокировку, рассылку могла закончить другая реплика
+    if job is None or job.status != "running":
+        return None, None
+
+    counters = {"sent": job.sent, "failed": job.failed, "blocked": job.blocked}
+    blocked_ids: list[int] = []
+    queue: asyncio.Queue[int] = asyncio.Queue(maxsize=BROADCAST_WORKERS * 2)
+
+    async def worker():
+        while True:
+            user_id = await queue.get()
+            try:
+                # Рассылка уступает очередь ответам игрокам и админке
+                with outbound.priority("broadcast"):
+                    outcome = await _send(bot, user_id, job.text)
+                counters[outcome] += 1
+                if outcome == "blocked":
+                    blocked_ids.append(user_id)
+            finally:
+                queue.task_done()
+
+    workers = [asyncio.create_task(worker()) for _ in range(BROADCAST_WORKERS)]
+    progress_task = asyncio.create_task(_report_progress(bot, job, counters))
+    started = time.monotonic()
+
+    try:
+        # Id читаются порциями по ключу короткими запросами — их можно отдать реплике,
+        # не держа на ней транзакцию всё время рассылки
+        last_user_id = job.last_user_id
+        while True:
+            async with read_session() as scan:
+                chunk = (await scan.scalars(
+                    select(User.user_id)
+                    .where(User.user_id > last_user_id, User.bot_blocked.is_not(True))
+                    .order_by(User.user_id)
+                    .limit(BROADCAST_CHUNK)
+                )).all()
+            if not chunk:
+                break
+            last_user_id = chunk[-1]
+
+            for user_id in chunk:
+                await queue.put(user_id)
+            await queue.join()
+
+            await _checkpoint(job_id, chunk[-1], counters, blocked_ids)
+            blocked_ids.clear()
+    finally:
+        progress_task.cancel()
+        for task in workers:
+            task.cancel()
+
+    async with AsyncSessionLocal() as session:
+        await session.execute(
+            update(BroadcastJob)
+            .where(BroadcastJob.id == job_id)
+            .values(status="done", finished_at=datetime.utcnow(), **counters)
+        )
+        await session.commit()
+
+    try:
+        with outbound.priority("admin"):
+            await bot.edit_message_text(
+                format_progress(job_id, counters, finished=True)
+                + f"\nВремя: {int(time.monotonic() - started)} сек",
+                chat_id=job.chat_id,
+                message_id=job.message_id,
+            )
+    except Exception:
+        logger.warning("Failed to report broadcast #%s result", job_id, exc_info=True)
+
+    return job, counters
+
+
+def _spawn(bot: Bot, job_id: int, on_finish):
+    task = asyncio.create_task(_run(bot, job_id, on_finish))
+    _tasks[job_id] = task
+    task.add_done_callback(lambda _: _tasks.pop(job_id, None))
+
+
+async def start(bot: Bot, admin_id: int, text: str, chat_id: int, on_finish=None) -> int:
+    progress = await bot.send_message(chat_id, "📣 Рассылка запускается…")
+
+    async with AsyncSessionLocal() as session:
+        job = BroadcastJob(
+            admin_id=admin_id,
+            text=text,
+            chat_id=chat_id,
+            message_id=progress.message_id,
+        )
+        session.add(job)
+        await session.commit()
+
+    _spawn(bot, job.id, on_finish)
+    return job.id
+
+
+async def resume(bot: Bot, on_finish=None):
+    # После перезапуска продолжаем незавершённые рассылки с последней контрольной точки
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(
+            select(BroadcastJob.id).where(BroadcastJob.status == "running")
+        )
+        job_ids = result.scalars().all()
+
+    for job_id in job_ids:
+        if job_id not in _tasks:
+            _spawn(bot, job_id, on_finish)
@@ -1,33 +1,119 @@
+import asyncio
+import bisect
 import os
+import time
 from datetime import datetime
 
-from sqlalchemy import BigInteger, Integer, Float, DateTime, Boolean, ForeignKey
+from sqlalchemy import BigInteger, Integer, Float, DateTime, Boolean, ForeignKey, String, Text, text
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.orm import declarative_base, Mapped, mapped_column
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+
+def _asyncpg_url(url: str) -> str:
+    if url.startswith("postgres://"):
+        return url.replace("postgres://", "postgresql+asyncpg://", 1)
+    if url.startswith("postgresql://"):
+        return url.replace("postgresql://", "postgresql+asyncpg://", 1)
+    return url
+
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 
 if not DATABASE_URL:
     raise ValueError("DATABASE_URL not set!")
 
-if DATABASE_URL.startswith("postgres://"):
-    DATABASE_URL = DATABASE_URL.replace(
-        "postgres://",
-        "postgresql+asyncpg://",
-        1
-    )
-elif DATABASE_URL.startswith("postgresql://"):
-    DATABASE_URL = DATABASE_URL.replace(
-        "postgresql://",
-        "postgresql+asyncpg://",
-        1
+DATABASE_URL = _asyncpg_url(DATABASE_URL)
+
+# Реплика только для чтения: рейтинги, статистика, обход игроков в рассылке
+DATABASE_REPLICA_URL = os.getenv("DATABASE_REPLICA_URL")
+if DATABASE_REPLICA_URL:
+    DATABASE_REPLICA_URL = _asyncpg_url(DATABASE_REPLICA_URL)
+
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "-1"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "0") == "1"
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100"))
+
+# Границы корзин гистограммы ожидания соединения, в секундах
+POOL_WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+pool_wait_counts = [0] * (len(POOL_WAIT_BUCKETS) + 1)
+pool_timeouts = 0
+pool_wait_observers: list = []
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    # Замеряем, сколько обработчик ждал соединение из пула
+    def _do_get(self):
+        global pool_timeouts
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            # Ошибки подключения к базе — не таймаут ожидания пула
+            pool_timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - started
+            pool_wait_counts[bisect.bisect_left(POOL_WAIT_BUCKETS, waited)] += 1
+            for observer in pool_wait_observers:
+                observer(waited, engine=self.logging_name)
+
+
+def _create_engine(url: str, name: str):
+    # name попадает в метки метрик пула (pool.logging_name переживает пересоздание пула)
+    return create_async_engine(
+        url,
+        poolclass=TimedQueuePool,
+        pool_logging_name=name,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
+        connect_args={
+            "statement_cache_size": DB_STATEMENT_CACHE_SIZE,
+            "prepared_statement_cache_size": DB_STATEMENT_CACHE_SIZE,
+        },
     )
 
-engine = create_async_engine(DATABASE_URL)
+
+engine = _create_engine(DATABASE_URL, "primary")
 AsyncSessionLocal = async_sessionmaker(engine, expire_on_commit=False)
+
+replica_engine = _create_engine(DATABASE_REPLICA_URL, "replica") if DATABASE_REPLICA_URL else None
+ReplicaSessionLocal = async_sessionmaker(replica_engine, expire_on_commit=False) if replica_engine else None
 Base = declarative_base()
 
 
+async def warm_up_pool():
+    # Открываем постоянную часть пула заранее, чтобы первые апдейты не ждали подключения
+    connections = await asyncio.gather(*(engine.connect() for _ in range(DB_POOL_SIZE)))
+    try:
+        await asyncio.gather(*(conn.execute(text("SELECT 1")) for conn in connections))
+    finally:
+        await asyncio.gather(*(conn.close() for conn in connections))
+
+
+def pool_stats() -> dict:
+    pool = engine.sync_engine.pool
+    return {
+        "size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "checked_in": pool.checkedin(),
+        "overflow": max(pool.overflow(), 0),
+        "max_overflow": DB_MAX_OVERFLOW,
+        "timeouts": pool_timeouts,
+        "wait_histogram": dict(zip(
+            [f"<={bound * 1000:g}ms" for bound in POOL_WAIT_BUCKETS] + ["slower"],
+            pool_wait_counts,
+        )),
+    }
+
+
 class User(Base):
     __tablename__ = "users"
 
@@ -46,6 +132,10 @@ class User(Base):
     referral_code: Mapped[str | None] = mapped_column(nullable=True, unique=True)
     referrals_count: Mapped[int] = mapped_column(Integer, default=0)
     referral_earned: Mapped[int] = mapped_column(Integer, default=0)
+    username: Mapped[str | None] = mapped_column(nullable=True)
+    first_name: Mapped[str | None] = mapped_column(nullable=True)
+    bot_blocked: Mapped[bool] = mapped_column(Boolean, default=False)
+    last_seen_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
 
     last_energy_update: Mapped[datetime] = mapped_column(
         DateTime, default=datetime.utcnow
@@ -53,4 +143,34 @@ class User(Base):
     last_farm_update: Mapped[datetime] = mapped_column(
         DateTime, default=datetime.utcnow
     )
-    
+
+
+class BroadcastJob(Base):
+    __tablename__ = "broadcast_jobs"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    admin_id: Mapped[int] = mapped_column(BigInteger)
+    text: Mapped[str] = mapped_column(Text)
+    status: Mapped[str] = mapped_column(String(16), default="running")
+
+    last_user_id: Mapped[int] = mapped_column(BigInteger, default=0)
+    sent: Mapped[int] = mapped_column(Integer, default=0)
+    failed: Mapped[int] = mapped_column(Integer, default=0)
+    blocked: Mapped[int] = mapped_column(Integer, default=0)
+
+    chat_id: Mapped[int] = mapped_column(BigInteger)
+    message_id: Mapped[int | None] = mapped_column(Integer, nullable=True)
+
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    finished_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
+
+
+class AdminAction(Base):
+    __tablename__ = "admin_actions"
+
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
+    actor_id: Mapped[int] = mapped_column(BigInteger)
+    action: Mapped[str] = mapped_column(String(64))
+    target_id: Mapped[int | None] = mapped_column(BigInteger, nullable=True)
+    value: Mapped[str | None] = mapped_column(Text, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
@@ -0,0 +1,72 @@
+import argparse
+import asyncio
+import itertools
+import os
+import time
+
+import aiohttp
+
+
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+# Локальная замена Telegram: шлёт синтетические апдейты на вебхук бота.
+# make_update общий с loadtest.py и bench_routing.py
+_update_ids = itertools.count(1)
+
+
+def make_update(user_id: int, text: str) -> dict:
+    update_id = next(_update_ids)
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private", "first_name": f"Игрок {user_id}"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"Игрок {user_id}", "username": f"player{user_id}"},
+            "text": text,
+        },
+    }
+
+
+async def send_updates(url: str, secret: str | None, users: int, updates: int, text: str, concurrency: int):
+    headers = {SECRET_HEADER: secret} if secret else {}
+    statuses: dict[int, int] = {}
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async with aiohttp.ClientSession(headers=headers) as session:
+        async def post(i: int):
+            async with semaphore:
+                async with session.post(url, json=make_update(1 + i % users, text)) as response:
+                    statuses[response.status] = statuses.get(response.status, 0) + 1
+
+        started = time.monotonic()
+        await asyncio.gather(*(post(i) for i in range(updates)))
+        elapsed = time.monotonic() - started
+
+        async with session.get(f"{url}/stats") as response:
+            stats = await response.json()
+
+    print(f"Отправлено {updates} апдейтов за {elapsed:.2f} сек ({updates / elapsed:.0f}/сек)")
+    print(f"Ответы вебхука: {statuses}")
+    print(f"Состояние очереди: {stats}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Шлёт синтетические апдейты на локальный вебхук")
+    parser.add_argument("--url", default=f"http://127.0.0.1:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    parser.add_argument("--secret", default=WEBHOOK_SECRET)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--updates", type=int, default=1000)
+    parser.add_argument("--text", default="👇 Тап")
+    parser.add_argument("--concurrency", type=int, default=50)
+    args = parser.parse_args()
+
+    asyncio.run(send_updates(args.url, args.secret, args.users, args.updates, args.text, args.concurrency))
+
+
+if __name__ == "__main__":
+    main()
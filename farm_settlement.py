@@ -0,0 +1,89 @@
+import asyncio
+import logging
+import os
+
+from sqlalchemy import select, text, update
+
+import game
+import leaderboard
+import ledger
+from database import User, engine
+
+
+FARM_SETTLE_INTERVAL_SECONDS = int(os.getenv("FARM_SETTLE_INTERVAL_SECONDS", "300"))
+FARM_SETTLE_BATCH = int(os.getenv("FARM_SETTLE_BATCH", "1000"))
+FARM_SETTLE_LOCK_KEY = 5004
+
+logger = logging.getLogger(__name__)
+
+_settle_task: asyncio.Task | None = None
+settled_users = 0
+
+
+def _batch_statement(after_id: int):
+    # Следующая пачка фармеров по первичному ключу; строки, которые прямо сейчас пишет игрок, пропускаем
+    batch = (
+        select(User.user_id, game.farm_earned().label("farm"))
+        .where(User.auto_farm_enabled, User.user_id > after_id, game.farm_earned() > 0)
+        .order_by(User.user_id)
+        .limit(FARM_SETTLE_BATCH)
+        .with_for_update(skip_locked=True)
+        .subquery()
+    )
+    return (
+        update(User)
+        .where(User.user_id == batch.c.user_id)
+        .values(**game.farm_catch_up())
+        .returning(User.user_id, User.balance, batch.c.farm)
+    )
+
+
+async def settle() -> int:
+    # Начисляет накопленный авто-фарм всем фармерам: каждая пачка — отдельная короткая транзакция
+    global settled_users
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        if not await conn.scalar(text("SELECT pg_try_advisory_lock(:key)"), {"key": FARM_SETTLE_LOCK_KEY}):
+            return 0
+
+        settled = 0
+        after_id = 0
+        try:
+            while True:
+                # Один оператор — одна транзакция: блокировки пачки держатся миллисекунды
+                rows = (await conn.execute(_batch_statement(after_id))).all()
+                if not rows:
+                    break
+
+                for user_id, balance, farm in rows:
+                    ledger.record(user_id, farm, "farm")
+                    leaderboard.observe("balance", user_id, balance)
+                settled += len(rows)
+                after_id = max(row.user_id for row in rows)
+                if len(rows) < FARM_SETTLE_BATCH:
+                    break
+        finally:
+            await conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": FARM_SETTLE_LOCK_KEY})
+
+    settled_users = settled
+    return settled
+
+
+async def _settle_loop():
+    while True:
+        await asyncio.sleep(FARM_SETTLE_INTERVAL_SECONDS)
+        try:
+            await settle()
+        except Exception:
+            logger.exception("Failed to settle auto-farm income")
+
+
+async def start():
+    global _settle_task
+    if FARM_SETTLE_INTERVAL_SECONDS > 0:
+        _settle_task = asyncio.create_task(_settle_loop())
+
+
+async def stop():
+    if _settle_task is not None:
+        _settle_task.cancel()
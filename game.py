@@ -0,0 +1,318 @@
+import math
+from datetime import datetime
+
+from sqlalchemy import BigInteger, Integer, Numeric, and_, case, cast, func, select, update
+
+import ledger
+import user_cache
+from database import AsyncSessionLocal, User
+
+
+ENERGY_PRICE = 200
+REGEN_STEP = 0.5
+MAX_ENERGY_STEP = 25
+
+
+# -------- СТОИМОСТЬ УЛУЧШЕНИЙ --------
+def tap_upgrade_cost(tap_power: int) -> int:
+    return tap_power * 100
+
+
+def regen_upgrade_cost(energy_regen: float) -> int:
+    return int(energy_regen * 200)
+
+
+def max_energy_upgrade_cost(max_energy: int) -> int:
+    return max_energy * 10
+
+
+def auto_farm_upgrade_cost(auto_farm_level: int) -> int:
+    return (auto_farm_level + 1) * 500
+
+
+# Каждый следующий уровень дороже предыдущего на постоянный шаг,
+# поэтому цена n уровней подряд — сумма арифметической прогрессии
+TAP_COST_STEP = 100
+REGEN_COST_STEP = int(REGEN_STEP * 200)
+MAX_ENERGY_COST_STEP = MAX_ENERGY_STEP * 10
+AUTO_FARM_COST_STEP = 500
+
+
+def series_cost(first, step: int, levels):
+    return levels * (2 * first + step * (levels - 1)) // 2
+
+
+def affordable_levels(first: int, step: int, budget: int, limit: int | None = None) -> int:
+    # Наибольшее n, при котором series_cost(first, step, n) <= budget, — корень квадратного неравенства
+    if budget < first:
+        return 0
+    b = 2 * first - step
+    levels = (math.isqrt(b * b + 8 * step * budget) - b) // (2 * step)
+    return levels if limit is None else min(levels, limit)
+
+
+# -------- ТЕКУЩЕЕ СОСТОЯНИЕ --------
+# В базе хранятся якоря: значение и момент, с которого оно растёт.
+# Текущие энергия и баланс вычисляются при чтении, строка переписывается только при действии игрока.
+def energy_at(user, now: datetime) -> float:
+    seconds = (now - user.last_energy_update).total_seconds()
+    return min(user.max_energy, user.energy + seconds * user.energy_regen)
+
+
+def farm_earned_at(user, now: datetime) -> int:
+    if not user.auto_farm_enabled or user.auto_farm_level == 0:
+        return 0
+    seconds = (now - user.last_farm_update).total_seconds()
+    return int(seconds * user.auto_farm_level)
+
+
+def balance_at(user, now: datetime) -> int:
+    return user.balance + farm_earned_at(user, now)
+
+
+def affordable_taps(energy: float, tap_power: int, count: int) -> int:
+    if tap_power <= 0:
+        return count
+    return min(count, int(energy // tap_power))
+
+
+def settle(user, now: datetime | None = None) -> int:
+    # Переносит якоря на текущий момент перед изменением регена, уровня фарма или энергии
+    now = now or datetime.utcnow()
+    earned = farm_earned_at(user, now)
+    user.energy = energy_at(user, now)
+    user.last_energy_update = now
+    if user.auto_farm_enabled and user.auto_farm_level != 0:
+        user.balance += earned
+        user.last_farm_update = now
+    return earned
+
+
+# -------- ВЫРАЖЕНИЯ ДЛЯ SQL --------
+def sql_now():
+    return func.timezone("utc", func.now())
+
+
+def _elapsed(column):
+    return func.extract("epoch", sql_now() - column)
+
+
+def _farm_active():
+    return and_(User.auto_farm_enabled.is_(True), User.auto_farm_level != 0)
+
+
+def current_energy():
+    return func.least(
+        User.max_energy,
+        User.energy + _elapsed(User.last_energy_update) * User.energy_regen,
+    )
+
+
+def farm_earned():
+    return case(
+        (_farm_active(), cast(func.floor(_elapsed(User.last_farm_update) * User.auto_farm_level), Integer)),
+        else_=0,
+    )
+
+
+def current_balance():
+    return User.balance + farm_earned()
+
+
+def farm_catch_up() -> dict:
+    # Начисление авто-фарма относительно якоря в самой строке: не задваивается с другими писателями
+    return {
+        "balance": current_balance(),
+        "last_farm_update": case((_farm_active(), sql_now()), else_=User.last_farm_update),
+    }
+
+
+def _catch_up() -> dict:
+    # Реген энергии и начисления авто-фарма фиксируются в том же UPDATE, что и само действие
+    return {
+        "energy": current_energy(),
+        "last_energy_update": sql_now(),
+        **farm_catch_up(),
+    }
+
+
+async def get_state(user_id: int, session=None):
+    stmt = select(
+        User.user_id,
+        current_balance().label("balance"),
+        current_energy().label("energy"),
+        User.max_energy,
+        User.tap_power,
+        User.energy_regen,
+        User.auto_farm_level,
+        User.auto_farm_enabled,
+    ).where(User.user_id == user_id)
+
+    if session is not None:
+        return (await session.execute(stmt)).one_or_none()
+
+    async with AsyncSessionLocal() as session:
+        return (await session.execute(stmt)).one_or_none()
+
+
+def _affordable_levels(first, step: int):
+    # То же, что affordable_levels, но внутри UPDATE; в numeric с запасом знаков корень не округлится вверх
+    budget = cast(func.greatest(current_balance(), 0), Numeric(60, 20))
+    b = 2 * cast(first, Numeric(60, 20)) - step
+    root = func.floor(func.sqrt(b * b + 8 * step * budget))
+    return cast(func.floor((root - b) / (2 * step)), BigInteger)
+
+
+async def _apply(user_id: int, condition, values: dict, reason: str, level=None):
+    # Баланс и фарм до изменения читаются под блокировкой строки в том же запросе — для журнала баланса
+    columns = [User.user_id, User.balance, farm_earned().label("farm")]
+    returning = []
+    if level is not None:
+        # Сколько уровней купили: разница уровня до и после
+        columns.append(level.label("level"))
+    before = (
+        select(*columns)
+        .where(User.user_id == user_id)
+        .with_for_update()
+        .subquery()
+    )
+    if level is not None:
+        returning.append((level - before.c.level).label("levels"))
+    stmt = (
+        update(User)
+        .where(User.user_id == before.c.user_id, condition)
+        .values(**{**_catch_up(), **values})
+        .returning(
+            *user_cache.CACHE_COLUMNS,
+            (User.balance - before.c.balance).label("balance_delta"),
+            before.c.farm.label("farm_delta"),
+            *returning,
+        )
+    )
+
+    async with AsyncSessionLocal() as session:
+        row = (await session.execute(stmt)).one_or_none()
+        if row is not None:
+            await session.commit()
+            user_cache.store(row)
+            ledger.record(user_id, row.farm_delta, "farm")
+            ledger.record(user_id, row.balance_delta - row.farm_delta, reason)
+            return row, True
+
+        # Условие не выполнено: отдаём текущее состояние, чтобы показать игроку причину
+        return await get_state(user_id, session), False
+
+
+async def _buy_levels(user_id: int, first, step: int, count: int | None, level, values, reason: str):
+    # count=None — сколько хватает денег; явное число уровней покупается целиком или не покупается.
+    # Любое число уровней покупается одним UPDATE
+    if count is not None and count < 1:
+        raise ValueError(f"count must be positive, got {count}")
+    balance = current_balance()
+    if count == 1:
+        levels, cost, condition = 1, first, balance >= first
+    elif count is None:
+        levels = _affordable_levels(first, step)
+        cost = series_cost(cast(first, BigInteger), step, levels)
+        condition = levels >= 1
+    else:
+        levels, cost = count, series_cost(cast(first, BigInteger), step, count)
+        condition = balance >= cost
+
+    row, upgraded = await _apply(
+        user_id,
+        condition,
+        {"balance": balance - cost, **values(levels)},
+        reason,
+        level=level,
+    )
+    return row, round(row.levels) if upgraded else 0
+
+
+# -------- ДЕЙСТВИЯ ИГРОКА --------
+async def tap(user_id: int, count: int = 1):
+    # count > 1 — несколько тапов разом: применяется столько, на сколько хватает энергии
+    energy = current_energy()
+    taps = cast(func.least(count, func.floor(energy / func.greatest(User.tap_power, 1))), Integer)
+    return await _apply(
+        user_id,
+        energy >= User.tap_power,
+        {
+            "energy": energy - taps * User.tap_power,
+            "balance": current_balance() + taps * User.tap_power,
+        },
+        "tap",
+    )
+
+
+# Улучшения возвращают строку и число купленных уровней (0 — не хватило денег)
+async def upgrade_tap(user_id: int, count: int | None = 1):
+    return await _buy_levels(
+        user_id,
+        User.tap_power * 100,
+        TAP_COST_STEP,
+        count,
+        User.tap_power,
+        lambda levels: {"tap_power": User.tap_power + levels},
+        "upgrade_tap",
+    )
+
+
+async def upgrade_regen(user_id: int, count: int | None = 1):
+    return await _buy_levels(
+        user_id,
+        cast(func.floor(User.energy_regen * 200), Integer),
+        REGEN_COST_STEP,
+        count,
+        User.energy_regen / REGEN_STEP,
+        lambda levels: {"energy_regen": User.energy_regen + REGEN_STEP * levels},
+        "upgrade_regen",
+    )
+
+
+async def buy_energy(user_id: int):
+    balance = current_balance()
+    return await _apply(
+        user_id,
+        balance >= ENERGY_PRICE,
+        {
+            "balance": balance - ENERGY_PRICE,
+            "energy": User.max_energy,
+        },
+        "buy_energy",
+    )
+
+
+async def upgrade_max_energy(user_id: int, count: int | None = 1):
+    return await _buy_levels(
+        user_id,
+        User.max_energy * 10,
+        MAX_ENERGY_COST_STEP,
+        count,
+        User.max_energy / MAX_ENERGY_STEP,
+        lambda levels: {
+            "max_energy": User.max_energy + MAX_ENERGY_STEP * levels,
+            "energy": func.least(
+                User.max_energy + MAX_ENERGY_STEP * levels,
+                current_energy() + MAX_ENERGY_STEP * levels,
+            ),
+        },
+        "upgrade_max_energy",
+    )
+
+
+async def upgrade_auto_farm(user_id: int, count: int | None = 1):
+    return await _buy_levels(
+        user_id,
+        (User.auto_farm_level + 1) * 500,
+        AUTO_FARM_COST_STEP,
+        count,
+        User.auto_farm_level,
+        lambda levels: {
+            "auto_farm_level": User.auto_farm_level + levels,
+            "auto_farm_enabled": True,
+            # Накопленное до покупки начисляется по старому уровню, дальше считаем с текущего момента
+            "last_farm_update": sql_now(),
+        },
+        "upgrade_auto_farm",
+    )
@@ -0,0 +1,174 @@
+import asyncio
+import bisect
+import os
+import time
+
+from sqlalchemy import Float, bindparam, desc, func, or_, select
+from sqlalchemy.dialects.postgresql import ARRAY
+
+from database import User
+from replica import read_session
+
+
+LEADERBOARD_TTL_SECONDS = float(os.getenv("LEADERBOARD_TTL_SECONDS", "30"))
+LEADERBOARD_SIZE = 10
+LEADERBOARD_EXACT_RANK_LIMIT = int(os.getenv("LEADERBOARD_EXACT_RANK_LIMIT", "10000"))
+LEADERBOARD_RANK_TTL_SECONDS = float(os.getenv("LEADERBOARD_RANK_TTL_SECONDS", "600"))
+LEADERBOARD_RANK_BUCKETS = 1000
+
+METRICS = {
+    "balance": User.balance,
+    "auto_farm": User.auto_farm_level,
+    "regen": User.energy_regen,
+}
+
+blocked_user_ids: set[int] = set()
+
+_entries: dict[str, list[tuple[int, float]]] = {}
+_fetched_at: dict[str, float] = {}
+_locks = {metric: asyncio.Lock() for metric in METRICS}
+# Квантили показателя для примерного места: (когда посчитаны, всего игроков, границы по убыванию)
+_quantiles: dict[str, tuple[float, int, list[float]]] = {}
+_quantile_locks = {metric: asyncio.Lock() for metric in METRICS}
+
+
+def _is_fresh(metric: str) -> bool:
+    return time.monotonic() - _fetched_at.get(metric, 0) < LEADERBOARD_TTL_SECONDS
+
+
+def _visible(stmt):
+    if blocked_user_ids:
+        stmt = stmt.where(User.user_id.not_in(blocked_user_ids))
+    return stmt
+
+
+async def refresh(metric: str):
+    column = METRICS[metric]
+    stmt = _visible(select(User.user_id, column).order_by(desc(column), User.user_id).limit(LEADERBOARD_SIZE))
+
+    async with read_session() as session:
+        result = await session.execute(stmt)
+        _entries[metric] = [(user_id, value) for user_id, value in result.all()]
+    _fetched_at[metric] = time.monotonic()
+
+
+async def get_top(metric: str) -> list[tuple[int, float]]:
+    if not _is_fresh(metric):
+        async with _locks[metric]:
+            # Пока ждали блокировку, список мог обновить другой запрос
+            if not _is_fresh(metric):
+                await refresh(metric)
+    return _entries[metric]
+
+
+def observe(metric: str, user_id: int, value: float):
+    # Записи, меняющие показатель игрока, сразу правят закэшированный топ
+    entries = _entries.get(metric)
+    if entries is None or user_id in blocked_user_ids:
+        return
+
+    is_full = len(entries) >= LEADERBOARD_SIZE
+    cutoff = entries[-1][1] if entries else None
+    position = next((i for i, (uid, _) in enumerate(entries) if uid == user_id), None)
+
+    if position is None:
+        if is_full and value <= cutoff:
+            return
+        updated = entries + [(user_id, value)]
+    else:
+        if is_full and value < cutoff:
+            # Игрок опустился ниже отсечки: его место может занять кто-то вне кэша
+            _fetched_at.pop(metric, None)
+            return
+        updated = entries[:position] + [(user_id, value)] + entries[position + 1:]
+
+    updated.sort(key=lambda entry: (-entry[1], entry[0]))
+    _entries[metric] = updated[:LEADERBOARD_SIZE]
+
+
+# -------- СТРАНИЦЫ --------
+# Порядок рейтинга — (показатель DESC, user_id): ровно индексы idx_users_*_top.
+# Страница продолжается от последней показанной строки, без OFFSET.
+def parse_value(metric: str, raw: str):
+    # Значение из callback_data приводится к типу колонки, иначе сравнение не попадёт в индекс
+    return METRICS[metric].type.python_type(raw)
+
+
+def _after(column, value, user_id: int):
+    return column <= value, or_(column < value, User.user_id > user_id)
+
+
+def _before(column, value, user_id: int):
+    return column >= value, or_(column > value, User.user_id < user_id)
+
+
+async def page_after(metric: str, value, user_id: int, limit: int = LEADERBOARD_SIZE) -> tuple[list, bool]:
+    column = METRICS[metric]
+    stmt = _visible(
+        select(User.user_id, column)
+        .where(*_after(column, value, user_id))
+        .order_by(desc(column), User.user_id)
+        .limit(limit + 1)
+    )
+    async with read_session() as session:
+        rows = [(uid, val) for uid, val in (await session.execute(stmt)).all()]
+    return rows[:limit], len(rows) > limit
+
+
+async def page_before(metric: str, value, user_id: int, limit: int = LEADERBOARD_SIZE) -> list:
+    # Тот же индекс в обратную сторону, строки разворачиваем обратно
+    column = METRICS[metric]
+    stmt = _visible(
+        select(User.user_id, column)
+        .where(*_before(column, value, user_id))
+        .order_by(column, desc(User.user_id))
+        .limit(limit)
+    )
+    async with read_session() as session:
+        rows = [(uid, val) for uid, val in (await session.execute(stmt)).all()]
+    rows.reverse()
+    return rows
+
+
+# -------- МЕСТО ИГРОКА --------
+async def _refresh_quantiles(metric: str):
+    column = METRICS[metric]
+    fractions = [i / LEADERBOARD_RANK_BUCKETS for i in range(1, LEADERBOARD_RANK_BUCKETS + 1)]
+    stmt = _visible(select(
+        func.count(),
+        func.percentile_disc(bindparam("fractions", fractions, type_=ARRAY(Float)))
+        .within_group(desc(column))
+        .cast(ARRAY(Float)),
+    ))
+    async with read_session() as session:
+        total, boundaries = (await session.execute(stmt)).one()
+    _quantiles[metric] = (time.monotonic(), total, [-value for value in boundaries or []])
+
+
+async def _approximate_rank(metric: str, value) -> int:
+    cached = _quantiles.get(metric)
+    if cached is None or time.monotonic() - cached[0] >= LEADERBOARD_RANK_TTL_SECONDS:
+        async with _quantile_locks[metric]:
+            cached = _quantiles.get(metric)
+            if cached is None or time.monotonic() - cached[0] >= LEADERBOARD_RANK_TTL_SECONDS:
+                await _refresh_quantiles(metric)
+                cached = _quantiles[metric]
+
+    # Сколько границ квантилей выше значения игрока — столько долей рейтинга впереди
+    _, total, boundaries = cached
+    if not boundaries:
+        return 1
+    ahead = bisect.bisect_left(boundaries, -value)
+    return max(LEADERBOARD_EXACT_RANK_LIMIT, int((ahead + 0.5) * total / len(boundaries))) + 1
+
+
+async def rank(metric: str, user_id: int, value) -> tuple[int, bool]:
+    # Точное место считается по индексу, но не дальше LEADERBOARD_EXACT_RANK_LIMIT строк;
+    # ниже — оценка по квантилям, которые пересчитываются раз в LEADERBOARD_RANK_TTL_SECONDS
+    column = METRICS[metric]
+    ahead = _visible(select(User.user_id).where(*_before(column, value, user_id)).limit(LEADERBOARD_EXACT_RANK_LIMIT))
+    async with read_session() as session:
+        count = await session.scalar(select(func.count()).select_from(ahead.subquery()))
+    if count < LEADERBOARD_EXACT_RANK_LIMIT:
+        return count + 1, True
+    return await _approximate_rank(metric, value), False
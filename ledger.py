@@ -0,0 +1,184 @@
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+from database import AsyncSessionLocal, engine
+
+
+LEDGER_FLUSH_INTERVAL_MS = int(os.getenv("LEDGER_FLUSH_INTERVAL_MS", "1000"))
+LEDGER_SNAPSHOT_SECONDS = int(os.getenv("LEDGER_SNAPSHOT_SECONDS", "3600"))
+LEDGER_LOCK_KEY = 5003
+# Записи журнала уходят в базу с задержкой до LEDGER_FLUSH_INTERVAL_MS в каждом процессе:
+# сверяем только игроков, у которых столько времени не было движений
+LEDGER_RECONCILE_DELAY_SECONDS = 60
+LEDGER_COLUMNS = ("user_id", "delta", "reason", "created_at")
+
+logger = logging.getLogger(__name__)
+
+_buffer: list[tuple] = []
+_partitions: set[datetime] = set()
+_flush_lock = asyncio.Lock()
+_tasks: list[asyncio.Task] = []
+drift_users = 0
+
+
+def record(user_id: int, delta: int, reason: str):
+    # Изменение баланса копится в памяти и уходит в базу одним COPY
+    if delta:
+        _buffer.append((user_id, int(delta), reason, datetime.utcnow()))
+
+
+# -------- ПАРТИЦИИ --------
+def _month_start(moment: datetime) -> datetime:
+    return datetime(moment.year, moment.month, 1)
+
+
+def _next_month(month: datetime) -> datetime:
+    return (month + timedelta(days=32)).replace(day=1)
+
+
+async def _ensure_partition(conn, month: datetime):
+    if month in _partitions:
+        return
+    await conn.execute(text(
+        f"CREATE TABLE IF NOT EXISTS balance_ledger_{month:%Y_%m} PARTITION OF balance_ledger "
+        f"FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{_next_month(month):%Y-%m-%d}')"
+    ))
+    _partitions.add(month)
+
+
+# -------- ЗАПИСЬ --------
+async def flush():
+    async with _flush_lock:
+        if not _buffer:
+            return
+
+        records = _buffer[:]
+        del _buffer[:len(records)]
+        try:
+            async with engine.connect() as conn:
+                for month in {_month_start(created_at) for *_, created_at in records}:
+                    await _ensure_partition(conn, month)
+                await conn.commit()
+
+                raw = await conn.get_raw_connection()
+                await raw.driver_connection.copy_records_to_table(
+                    "balance_ledger", records=records, columns=LEDGER_COLUMNS
+                )
+        except Exception:
+            _buffer[:0] = records
+            raise
+
+
+async def _flush_loop():
+    while True:
+        await asyncio.sleep(LEDGER_FLUSH_INTERVAL_MS / 1000)
+        try:
+            await flush()
+        except Exception:
+            logger.exception("Failed to write balance ledger")
+
+
+# -------- СНИМКИ --------
+async def snapshot():
+    # Для всех, у кого были движения с прошлого снимка: сверяем баланс с журналом и пишем новый снимок.
+    # Источник истины — users.balance: расхождение записывается в журнал записью "reconcile"
+    global drift_users
+    await flush()
+
+    async with AsyncSessionLocal() as session:
+        locked = await session.scalar(
+            text("SELECT pg_try_advisory_xact_lock(:key)"),
+            {"key": LEDGER_LOCK_KEY},
+        )
+        if not locked:
+            return
+
+        taken_at = datetime.utcnow() - timedelta(seconds=LEDGER_RECONCILE_DELAY_SECONDS)
+        since = await session.scalar(text("SELECT max(taken_at) FROM balance_snapshots"))
+        if since is None:
+            since = taken_at - timedelta(seconds=LEDGER_SNAPSHOT_SECONDS)
+        if since >= taken_at:
+            return
+        await _ensure_partition(session, _month_start(taken_at))
+
+        # Игроки, у которых движения после taken_at ещё идут, попадут в следующий снимок
+        active = (
+            "SELECT user_id FROM balance_ledger WHERE created_at > :since "
+            "GROUP BY user_id HAVING max(created_at) <= :taken_at"
+        )
+        # Одним оператором: снимок и сверка видят один и тот же баланс
+        drift_users = await session.scalar(
+            text(
+                f"WITH active AS ({active}), "
+                "state AS ("
+                "SELECT a.user_id, u.balance, u.balance - s.balance - ("
+                "SELECT coalesce(sum(delta), 0) FROM balance_ledger l "
+                "WHERE l.user_id = a.user_id AND l.created_at > s.taken_at"
+                ") AS drift FROM active a "
+                "JOIN users u ON u.user_id = a.user_id "
+                "LEFT JOIN LATERAL ("
+                "SELECT balance, taken_at FROM balance_snapshots s "
+                "WHERE s.user_id = a.user_id ORDER BY taken_at DESC LIMIT 1"
+                ") s ON true), "
+                "reconciled AS ("
+                "INSERT INTO balance_ledger (user_id, delta, reason, created_at) "
+                "SELECT user_id, drift, 'reconcile', :taken_at FROM state WHERE drift <> 0 "
+                "RETURNING user_id), "
+                "snapshots AS ("
+                "INSERT INTO balance_snapshots (user_id, balance, taken_at) "
+                "SELECT user_id, balance, :taken_at FROM state "
+                "ON CONFLICT DO NOTHING) "
+                "SELECT count(*) FROM reconciled"
+            ),
+            {"since": since, "taken_at": taken_at},
+        )
+        await session.commit()
+
+    if drift_users:
+        logger.warning("Balance ledger drift for %s users at %s, reconciled", drift_users, taken_at)
+
+
+async def _snapshot_loop():
+    while True:
+        await asyncio.sleep(LEDGER_SNAPSHOT_SECONDS)
+        try:
+            await snapshot()
+        except Exception:
+            logger.exception("Failed to take balance snapshot")
+
+
+# -------- ИСТОРИЯ --------
+async def history(user_id: int, limit: int = 20, before: datetime | None = None) -> list:
+    # Индекс (user_id, created_at DESC) в каждой партиции: последние записи без сортировки всего журнала
+    await flush()
+
+    query = "SELECT delta, reason, created_at FROM balance_ledger WHERE user_id = :user_id"
+    params = {"user_id": user_id, "limit": limit}
+    if before is not None:
+        query += " AND created_at < :before"
+        params["before"] = before
+    query += " ORDER BY created_at DESC LIMIT :limit"
+
+    async with AsyncSessionLocal() as session:
+        return (await session.execute(text(query), params)).all()
+
+
+# -------- ЗАПУСК --------
+async def start():
+    now = datetime.utcnow()
+    async with engine.begin() as conn:
+        await _ensure_partition(conn, _month_start(now))
+        await _ensure_partition(conn, _next_month(_month_start(now)))
+    _tasks.append(asyncio.create_task(_flush_loop()))
+    _tasks.append(asyncio.create_task(_snapshot_loop()))
+
+
+async def stop():
+    for task in _tasks:
+        task.cancel()
+    _tasks.clear()
+    await flush()
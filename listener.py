@@ -0,0 +1,55 @@
+import asyncio
+import logging
+
+from database import engine
+
+
+LISTEN_CHECK_INTERVAL = 2
+
+logger = logging.getLogger(__name__)
+
+
+class Listener:
+    # LISTEN на отдельном соединении. Оборванное соединение переподключается, а on_reconnect
+    # восстанавливает то, что могло измениться, пока уведомления не приходили
+    def __init__(self, channel: str, callback, on_reconnect):
+        self.channel = channel
+        self.callback = callback
+        self.on_reconnect = on_reconnect
+        self._connection = None
+        self._driver_connection = None
+        self._task: asyncio.Task | None = None
+
+    @property
+    def active(self) -> bool:
+        return self._connection is not None
+
+    async def _connect(self):
+        self._connection = await engine.connect()
+        raw_connection = await self._connection.get_raw_connection()
+        self._driver_connection = raw_connection.driver_connection
+        await self._driver_connection.add_listener(self.channel, self.callback)
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(LISTEN_CHECK_INTERVAL)
+            if not self._driver_connection.is_closed():
+                continue
+            logger.warning("LISTEN %s connection lost, reconnecting", self.channel)
+            try:
+                await self._connection.invalidate()
+                await self._connect()
+                await self.on_reconnect()
+            except Exception:
+                logger.exception("Failed to reconnect LISTEN %s", self.channel)
+
+    async def start(self):
+        await self._connect()
+        self._task = asyncio.create_task(self._watch())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+        if self._connection is not None:
+            await self._connection.close()
+            self._connection = None
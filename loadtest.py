@@ -0,0 +1,222 @@
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import statistics
+import time
+from datetime import datetime, timedelta
+
+import asyncpg
+
+from fake_sender import make_update
+
+# Бот импортируется позже: токен и лимиты должны быть заданы до создания Bot и middleware
+os.environ.setdefault("BOT_TOKEN", "42:LOADTEST")
+
+FIRST_USER_ID = 1_000_000_000
+SEED_BATCH = 50_000
+
+SCENARIOS = {
+    "tap": ["👇 Тап"],
+    "upgrade": ["⚡ Улучшить тап", "🚀 Улучшить реген", "💵 Купить энергию", "🔋 Увеличить макс. энергию", "🤖 Авто-фарм"],
+    "profile": ["📊 Профиль"],
+    "rating": ["💰 Топ по балансу", "🤖 Топ по авто-фарму", "🚀 Топ по регену"],
+}
+SCENARIOS["mixed"] = SCENARIOS["tap"] * 8 + SCENARIOS["upgrade"] + SCENARIOS["profile"] + SCENARIOS["rating"]
+
+USER_COLUMNS = (
+    "user_id",
+    "balance",
+    "energy",
+    "max_energy",
+    "tap_power",
+    "energy_regen",
+    "auto_farm_level",
+    "auto_farm_enabled",
+    "admin_rights",
+    "referrals_count",
+    "referral_earned",
+    "username",
+    "first_name",
+    "bot_blocked",
+    "last_energy_update",
+    "last_farm_update",
+)
+
+
+def _asyncpg_dsn() -> str:
+    url = os.environ["DATABASE_URL"]
+    for prefix in ("postgresql+asyncpg://", "postgres://"):
+        if url.startswith(prefix):
+            return "postgresql://" + url[len(prefix):]
+    return url
+
+
+# -------- НАПОЛНЕНИЕ БАЗЫ --------
+def _fake_user(user_id: int, now: datetime) -> tuple:
+    # Большинство игроков почти ничего не накопили, единицы — очень богаты
+    tap_power = max(1, int(random.lognormvariate(0.5, 1.0)))
+    auto_farm_level = int(random.expovariate(0.2)) if random.random() < 0.4 else 0
+    max_energy = 100 + 25 * int(random.expovariate(0.3))
+    seen = now - timedelta(seconds=random.randint(0, 30 * 86400))
+    return (
+        user_id,
+        min(int(random.lognormvariate(8, 2.5)), 2_000_000_000),
+        float(random.randint(0, max_energy)),
+        max_energy,
+        tap_power,
+        1 + 0.5 * int(random.expovariate(0.5)),
+        auto_farm_level,
+        auto_farm_level > 0,
+        False,
+        0,
+        0,
+        f"player{user_id}" if random.random() < 0.7 else None,
+        f"Игрок {user_id}",
+        random.random() < 0.05,
+        seen,
+        seen,
+    )
+
+
+async def seed(users: int, first_id: int):
+    import migrations
+
+    # Схема создаётся теми же миграциями, что и при старте бота
+    await migrations.migrate()
+
+    connection = await asyncpg.connect(_asyncpg_dsn())
+    try:
+        now = datetime.utcnow()
+        started = time.monotonic()
+        for start in range(0, users, SEED_BATCH):
+            records = [
+                _fake_user(first_id + i, now)
+                for i in range(start, min(users, start + SEED_BATCH))
+            ]
+            await connection.copy_records_to_table("users", records=records, columns=USER_COLUMNS)
+            print(f"Записано {start + len(records)} из {users}")
+        await connection.execute("ANALYZE users")
+    finally:
+        await connection.close()
+
+    print(f"Готово за {time.monotonic() - started:.1f} сек")
+
+
+# -------- НАГРУЗКА --------
+_message_ids = itertools.count(1)
+
+
+def _percentile(values: list[float], percent: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(len(ordered) * percent / 100))
+    return ordered[index]
+
+
+async def run(scenario: str, users: int, first_id: int, updates: int, concurrency: int):
+    from aiogram.methods import GetChat, SendMessage
+    from aiogram.types import Chat, Message
+    from sqlalchemy import event
+
+    import bot
+    import database
+
+    api_calls: dict[str, int] = {}
+
+    async def stub_request(bot, method, timeout=None):
+        # Ничего не уходит в сеть: отвечаем так, как ответил бы Telegram
+        name = type(method).__name__
+        api_calls[name] = api_calls.get(name, 0) + 1
+        if isinstance(method, SendMessage):
+            return Message(
+                message_id=next(_message_ids),
+                date=datetime.now(),
+                chat=Chat(id=method.chat_id, type="private"),
+                text=method.text,
+            )
+        if isinstance(method, GetChat):
+            raise RuntimeError("get_chat is not available in load test")
+        return True
+
+    # Подменяем только сетевой вызов: очередь исходящих (outbound) и метрики Bot API остаются
+    # middleware той же сессии и меряются вместе с ботом
+    bot.bot.session.make_request = stub_request
+
+    queries = 0
+
+    @event.listens_for(database.engine.sync_engine, "before_cursor_execute")
+    def count_query(conn, cursor, statement, parameters, context, executemany):
+        nonlocal queries
+        queries += 1
+
+    await database.warm_up_pool()
+    await bot.tap_buffer.start()
+    await bot.ledger.start()
+
+    texts = SCENARIOS[scenario]
+    latencies: list[float] = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def feed(i: int):
+        nonlocal errors
+        user_id = first_id + random.randrange(users)
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await bot.dp.feed_raw_update(bot.bot, make_update(user_id, random.choice(texts)))
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(feed(i) for i in range(updates)))
+    elapsed = time.perf_counter() - started
+    await bot.tap_buffer.stop()
+    await bot.ledger.stop()
+
+    print(f"Сценарий: {scenario}, апдейтов: {updates}, игроков: {users}, параллельно: {concurrency}")
+    print(f"Пропускная способность: {updates / elapsed:.0f} апдейтов/сек за {elapsed:.2f} сек")
+    print(
+        "Задержка, мс: "
+        f"p50={_percentile(latencies, 50) * 1000:.1f} "
+        f"p95={_percentile(latencies, 95) * 1000:.1f} "
+        f"p99={_percentile(latencies, 99) * 1000:.1f} "
+        f"среднее={statistics.fmean(latencies) * 1000:.1f}"
+    )
+    print(f"Ошибок: {errors}")
+    print(f"Запросов к базе: {queries} ({queries / updates:.2f} на апдейт)")
+    print(f"Вызовов Bot API: {sum(api_calls.values())} {api_calls}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный стенд бота без сети")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    seed_parser = subparsers.add_parser("seed", help="Залить в базу синтетических игроков через COPY")
+    seed_parser.add_argument("--users", type=int, default=1_000_000)
+    seed_parser.add_argument("--first-id", type=int, default=FIRST_USER_ID)
+
+    run_parser = subparsers.add_parser("run", help="Прогнать сценарий через dp.feed_update")
+    run_parser.add_argument("--scenario", choices=sorted(SCENARIOS), default="mixed")
+    run_parser.add_argument("--users", type=int, default=10_000)
+    run_parser.add_argument("--first-id", type=int, default=FIRST_USER_ID)
+    run_parser.add_argument("--updates", type=int, default=20_000)
+    run_parser.add_argument("--concurrency", type=int, default=100)
+    run_parser.add_argument("--no-throttle", action="store_true", help="Снять лимиты частоты для игроков")
+
+    args = parser.parse_args()
+    if args.command == "seed":
+        asyncio.run(seed(args.users, args.first_id))
+    else:
+        if args.no_throttle:
+            os.environ["THROTTLE_USER_RATE"] = os.environ["THROTTLE_USER_BURST"] = "1000000"
+            os.environ["THROTTLE_GLOBAL_RATE"] = os.environ["THROTTLE_GLOBAL_BURST"] = "1000000"
+        asyncio.run(run(args.scenario, args.users, args.first_id, args.updates, args.concurrency))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+import bisect
+import os
+import time
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware, Bot, Dispatcher
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.types import TelegramObject
+from aiohttp import web
+from sqlalchemy import event
+
+import database
+import farm_settlement
+import replica
+import user_cache
+
+
+METRICS_HOST = os.getenv("METRICS_HOST", "0.0.0.0")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry: list = []
+
+
+def _format_labels(labels: tuple, extra: str = "") -> str:
+    parts = [f'{key}="{value}"' for key, value in labels]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self.values: dict[tuple, float] = {}
+        _registry.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for labels, value in self.values.items():
+            lines.append(f"{self.name}{_format_labels(labels)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        # На каждый набор меток: счётчики корзин (последняя — +Inf), сумма
+        self.series: dict[tuple, list] = {}
+        _registry.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                bucket_labels = _format_labels(labels, 'le="' + le + '"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {cumulative}")
+        return lines
+
+
+class Gauge:
+    # Значение снимается в момент запроса /metrics; read может вернуть {метки: значение}
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, read: Callable[[], float | dict]):
+        self.name = name
+        self.help_text = help_text
+        self.read = read
+        _registry.append(self)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        value = self.read()
+        if isinstance(value, dict):
+            for labels, series_value in value.items():
+                lines.append(f"{self.name}{_format_labels(labels)} {series_value}")
+        else:
+            lines.append(f"{self.name} {value}")
+        return lines
+
+
+class ReadCounter(Gauge):
+    # Счётчик, который ведёт сам модуль (например, попадания в кэш): тоже снимается при запросе
+    kind = "counter"
+
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# -------- МЕТРИКИ --------
+handler_seconds = Histogram("bot_handler_seconds", "Handler latency")
+handler_errors = Counter("bot_handler_errors_total", "Handler exceptions")
+db_query_seconds = Histogram("bot_db_query_seconds", "Database statement latency")
+db_connection_held_seconds = Histogram("bot_db_connection_held_seconds", "Time a connection stays checked out")
+db_pool_wait_seconds = Histogram("bot_db_pool_wait_seconds", "Time spent waiting for a pooled connection")
+telegram_request_seconds = Histogram("bot_telegram_request_seconds", "Telegram Bot API call latency")
+telegram_retry_after = Counter("bot_telegram_retry_after_total", "Telegram flood control responses")
+telegram_errors = Counter("bot_telegram_errors_total", "Failed Telegram Bot API calls")
+
+
+def _engines() -> list[tuple[str, Any]]:
+    engines = [("primary", database.engine)]
+    if database.replica_engine is not None:
+        engines.append(("replica", database.replica_engine))
+    return engines
+
+
+def _per_pool(read: Callable[[Any], float]) -> Callable[[], dict]:
+    return lambda: {(("engine", name),): read(engine.sync_engine.pool) for name, engine in _engines()}
+
+
+Gauge("bot_db_pool_checked_out", "Connections in use", _per_pool(lambda pool: pool.checkedout()))
+Gauge("bot_db_pool_overflow", "Overflow connections in use", _per_pool(lambda pool: max(pool.overflow(), 0)))
+Gauge("bot_user_cache_size", "Players held in the user cache", lambda: user_cache.stats()["size"])
+ReadCounter("bot_user_cache_hits_total", "User cache hits", lambda: user_cache.hits)
+ReadCounter("bot_user_cache_misses_total", "User cache misses", lambda: user_cache.misses)
+Gauge(
+    "bot_db_replica_lag_seconds",
+    "Read replica lag at the last check, -1 when unavailable",
+    lambda: -1 if replica.lag_seconds is None else replica.lag_seconds,
+)
+Gauge("bot_farm_settled_users", "Players credited by the last auto-farm settlement pass", lambda: farm_settlement.settled_users)
+
+
+class MetricsMiddleware(BaseMiddleware):
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        route = data.get("route")
+        handler_object = data.get("handler")
+        if route is not None:
+            name = route.name
+        elif handler_object is not None:
+            name = handler_object.callback.__name__
+        else:
+            name = "unknown"
+
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            handler_errors.inc(handler=name)
+            raise
+        finally:
+            handler_seconds.observe(time.perf_counter() - started, handler=name)
+
+
+class TelegramApiMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot: Bot, method):
+        name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter:
+            telegram_retry_after.inc(method=name)
+            raise
+        except Exception:
+            telegram_errors.inc(method=name)
+            raise
+        finally:
+            telegram_request_seconds.observe(time.perf_counter() - started, method=name)
+
+
+def _instrument_engine(name: str, engine):
+    sync_engine = engine.sync_engine
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["query_started"].pop()
+        operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "OTHER"
+        db_query_seconds.observe(time.perf_counter() - started, engine=name, operation=operation)
+
+    @event.listens_for(sync_engine, "handle_error")
+    def handle_error(context):
+        stack = context.connection.info.get("query_started") if context.connection is not None else None
+        if stack:
+            stack.pop()
+
+    @event.listens_for(sync_engine.pool, "checkout")
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        connection_record.info["checked_out_at"] = time.perf_counter()
+
+    @event.listens_for(sync_engine.pool, "checkin")
+    def on_checkin(dbapi_connection, connection_record):
+        checked_out_at = connection_record.info.pop("checked_out_at", None)
+        if checked_out_at is not None:
+            db_connection_held_seconds.observe(time.perf_counter() - checked_out_at, engine=name)
+
+
+def instrument(dp: Dispatcher, bot: Bot):
+    dp.message.middleware(MetricsMiddleware())
+    dp.callback_query.middleware(MetricsMiddleware())
+    bot.session.middleware(TelegramApiMiddleware())
+    for name, engine in _engines():
+        _instrument_engine(name, engine)
+    database.pool_wait_observers.append(db_pool_wait_seconds.observe)
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+
+async def serve() -> web.AppRunner | None:
+    # В режиме вебхука /metrics отдаёт сервер вебхука, отдельный порт нужен только для polling
+    if not METRICS_PORT:
+        return None
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    return runner
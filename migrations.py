@@ -0,0 +1,167 @@
+from sqlalchemy import text
+from sqlalchemy.exc import ProgrammingError
+
+from database import AdminAction, Base, BroadcastJob, User, engine
+
+
+MIGRATION_LOCK_KEY = 5002
+
+
+class ConcurrentIndex:
+    # Строится без блокировки записи в таблицу, поэтому вне транзакции
+    def __init__(self, name: str, definition: str, unique: bool = False):
+        self.name = name
+        self.definition = definition
+        self.unique = unique
+
+
+def create_tables(*tables):
+    async def step(conn):
+        await conn.run_sync(Base.metadata.create_all, tables=[table.__table__ for table in tables])
+    return step
+
+
+MIGRATIONS = [
+    (1, "users table", [
+        create_tables(User),
+    ]),
+    (2, "admin rights and referrals", [
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS admin_rights BOOLEAN DEFAULT FALSE",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS invited_by BIGINT",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS referral_code TEXT",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS referrals_count INTEGER DEFAULT 0",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS referral_earned INTEGER DEFAULT 0",
+        ConcurrentIndex("idx_users_referral_code_unique", "users (referral_code)", unique=True),
+    ]),
+    (3, "leaderboard indexes", [
+        ConcurrentIndex("idx_users_balance_top", "users (balance DESC, user_id)"),
+        ConcurrentIndex("idx_users_auto_farm_top", "users (auto_farm_level DESC, user_id)"),
+        ConcurrentIndex("idx_users_regen_top", "users (energy_regen DESC, user_id)"),
+    ]),
+    (4, "player directory", [
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS username TEXT",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS first_name TEXT",
+        ConcurrentIndex("idx_users_username_lower", "users (lower(username))"),
+    ]),
+    (5, "broadcast jobs", [
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS bot_blocked BOOLEAN DEFAULT FALSE",
+        create_tables(BroadcastJob),
+    ]),
+    (6, "shared state store", [
+        "CREATE UNLOGGED TABLE IF NOT EXISTS bot_state ("
+        "namespace TEXT NOT NULL, "
+        "key BIGINT NOT NULL, "
+        "value TEXT NOT NULL, "
+        "expires_at DOUBLE PRECISION, "
+        "PRIMARY KEY (namespace, key))",
+    ]),
+    (7, "stats indexes", [
+        ConcurrentIndex("idx_users_admins", "users (user_id) WHERE admin_rights"),
+    ]),
+    (8, "activity tracking", [
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS last_seen_at TIMESTAMP",
+        ConcurrentIndex("idx_users_last_seen_at", "users (last_seen_at)"),
+    ]),
+    (9, "admin audit log", [
+        create_tables(AdminAction),
+        ConcurrentIndex("idx_admin_actions_actor", "admin_actions (actor_id, id DESC)"),
+        ConcurrentIndex("idx_admin_actions_target", "admin_actions (target_id, id DESC) WHERE target_id IS NOT NULL"),
+        ConcurrentIndex("idx_admin_actions_created_at", "admin_actions (created_at)"),
+    ]),
+    (10, "balance ledger", [
+        # Партиции по месяцам создаёт ledger.py заранее; индекс родителя наследуют все партиции
+        "CREATE TABLE IF NOT EXISTS balance_ledger ("
+        "user_id BIGINT NOT NULL, "
+        "delta BIGINT NOT NULL, "
+        "reason TEXT NOT NULL, "
+        "created_at TIMESTAMP NOT NULL) "
+        "PARTITION BY RANGE (created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_balance_ledger_user ON balance_ledger (user_id, created_at DESC)",
+        "CREATE TABLE IF NOT EXISTS balance_snapshots ("
+        "user_id BIGINT NOT NULL, "
+        "balance BIGINT NOT NULL, "
+        "taken_at TIMESTAMP NOT NULL, "
+        "PRIMARY KEY (user_id, taken_at))",
+        "CREATE INDEX IF NOT EXISTS idx_balance_snapshots_taken_at ON balance_snapshots (taken_at)",
+    ]),
+    (11, "auto-farm settlement", [
+        # Фоновое начисление идёт по фармерам пачками по user_id — индекс только по ним
+        ConcurrentIndex("idx_users_auto_farm_enabled", "users (user_id) WHERE auto_farm_enabled"),
+    ]),
+    (12, "tap journal segments", [
+        # Сегменты журнала tap_buffer и одиночные записи settle, уже попавшие в базу: повторный проигрыш их учитывает
+        "CREATE TABLE IF NOT EXISTS tap_journal_segments ("
+        "segment TEXT PRIMARY KEY, "
+        "applied_at TIMESTAMP NOT NULL DEFAULT (now() AT TIME ZONE 'utc'))",
+    ]),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+async def current_version(conn) -> int:
+    try:
+        return await conn.scalar(text("SELECT max(version) FROM schema_version")) or 0
+    except ProgrammingError:
+        await conn.rollback()
+        return 0
+
+
+async def _create_index_concurrently(conn, index: ConcurrentIndex):
+    # Прерванная сборка оставляет невалидный индекс, который IF NOT EXISTS молча пропустит
+    valid = await conn.scalar(
+        text("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)"),
+        {"name": index.name},
+    )
+    if valid is False:
+        await conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {index.name}"))
+
+    unique = "UNIQUE " if index.unique else ""
+    await conn.execute(text(
+        f"CREATE {unique}INDEX CONCURRENTLY IF NOT EXISTS {index.name} ON {index.definition}"
+    ))
+
+
+async def _apply(conn, version: int, description: str, steps: list):
+    async with engine.begin() as tx:
+        for step in steps:
+            if isinstance(step, str):
+                await tx.execute(text(step))
+            elif not isinstance(step, ConcurrentIndex):
+                await step(tx)
+
+    for step in steps:
+        if isinstance(step, ConcurrentIndex):
+            await _create_index_concurrently(conn, step)
+
+    async with engine.begin() as tx:
+        await tx.execute(
+            text("INSERT INTO schema_version (version, description) VALUES (:version, :description)"),
+            {"version": version, "description": description},
+        )
+
+
+async def migrate():
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+
+        # Быстрый путь: схема актуальна — холодный старт обходится одним запросом
+        if await current_version(conn) >= LATEST_VERSION:
+            return
+
+        await conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": MIGRATION_LOCK_KEY})
+        try:
+            await conn.execute(text(
+                "CREATE TABLE IF NOT EXISTS schema_version ("
+                "version INTEGER PRIMARY KEY, "
+                "description TEXT NOT NULL, "
+                "applied_at TIMESTAMP NOT NULL DEFAULT (now() AT TIME ZONE 'utc'))"
+            ))
+
+            # Пока ждали блокировку, миграции могла применить другая реплика
+            version = await current_version(conn)
+            for number, description, steps in MIGRATIONS:
+                if number > version:
+                    await _apply(conn, number, description, steps)
+        finally:
+            await conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": MIGRATION_LOCK_KEY})
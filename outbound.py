@@ -0,0 +1,329 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware, Bot, Dispatcher
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import (
+    CopyMessage,
+    EditMessageReplyMarkup,
+    EditMessageText,
+    ForwardMessage,
+    SendDocument,
+    SendMessage,
+    SendPhoto,
+)
+from aiogram.types import TelegramObject
+
+import metrics
+from ratelimit import TokenBucket
+from routing import get_flag
+from sweeper import IdleSweeper
+
+
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", "30"))
+OUTBOUND_CHAT_RATE = float(os.getenv("OUTBOUND_CHAT_RATE", "1"))
+OUTBOUND_CHAT_BURST = float(os.getenv("OUTBOUND_CHAT_BURST", "3"))
+OUTBOUND_GROUP_RATE = 20 / 60
+OUTBOUND_CONCURRENCY = int(os.getenv("OUTBOUND_CONCURRENCY", "16"))
+OUTBOUND_MAX_RETRIES = 3
+OUTBOUND_IDLE_SECONDS = 300
+
+# Меньше — раньше: ответы игрокам обгоняют админку, админка обгоняет рассылку
+PRIORITIES = {"interactive": 0, "admin": 1, "broadcast": 2}
+PRIORITY_NAMES = {value: name for name, value in PRIORITIES.items()}
+
+# Остальные методы (answerCallbackQuery и т.п.) под лимиты сообщений в чат не попадают
+PACED_METHODS = (
+    SendMessage,
+    EditMessageText,
+    EditMessageReplyMarkup,
+    CopyMessage,
+    ForwardMessage,
+    SendPhoto,
+    SendDocument,
+)
+EDIT_METHODS = (EditMessageText, EditMessageReplyMarkup)
+
+logger = logging.getLogger(__name__)
+
+_priority: ContextVar[int] = ContextVar("outbound_priority", default=PRIORITIES["interactive"])
+_coalesce_tag: ContextVar[str | None] = ContextVar("outbound_coalesce_tag", default=None)
+
+
+class Job:
+    __slots__ = ("priority", "seq", "chat_id", "key", "method", "make_request", "bot", "futures", "enqueued_at", "attempts")
+
+    def __init__(self, priority: int, chat_id, key, method, make_request, bot: Bot):
+        self.priority = priority
+        self.seq = next(_seq)
+        self.chat_id = chat_id
+        self.key = key
+        self.method = method
+        self.make_request = make_request
+        self.bot = bot
+        self.futures: list[asyncio.Future] = []
+        self.enqueued_at = time.perf_counter()
+        self.attempts = 0
+
+    def __lt__(self, other: "Job") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+_seq = itertools.count()
+_heap: list[Job] = []
+_pending: dict[tuple, Job] = {}
+_busy_chats: set = set()
+_chat_buckets: dict[Any, TokenBucket] = {}
+_global_bucket = TokenBucket(OUTBOUND_GLOBAL_RATE, OUTBOUND_GLOBAL_RATE)
+_wakeup = asyncio.Event()
+_task: asyncio.Task | None = None
+_sweeper = IdleSweeper(
+    _chat_buckets,
+    OUTBOUND_IDLE_SECONDS,
+    lambda chat_id, bucket, now: chat_id not in _busy_chats and now - bucket.updated > OUTBOUND_IDLE_SECONDS,
+)
+
+metrics.Gauge("bot_outbound_queue_depth", "Messages waiting to be sent", lambda: len(_heap))
+queue_wait_seconds = metrics.Histogram("bot_outbound_queue_wait_seconds", "Time a message waits for its turn")
+send_seconds = metrics.Histogram("bot_outbound_send_seconds", "Time from enqueue until Telegram accepted the message")
+coalesced_total = metrics.Counter("bot_outbound_coalesced_total", "Messages replaced by a newer one before sending")
+retries_total = metrics.Counter("bot_outbound_retries_total", "Sends repeated after retry_after")
+
+
+@contextmanager
+def priority(name: str):
+    token = _priority.set(PRIORITIES[name])
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+@contextmanager
+def coalesce(tag: str):
+    # Пока сообщение с этой меткой ждёт очереди в чате, новое заменяет его, а не встаёт следом.
+    # Ответы игрокам с меткой не ждут доставки: вызов сразу возвращает None, ошибки только логируются
+    token = _coalesce_tag.set(tag)
+    try:
+        yield
+    finally:
+        _coalesce_tag.reset(token)
+
+
+# -------- ОЧЕРЕДЬ --------
+def _chat_bucket(chat_id) -> TokenBucket:
+    bucket = _chat_buckets.get(chat_id)
+    if bucket is None:
+        # В группах Telegram пропускает около 20 сообщений в минуту
+        is_group = isinstance(chat_id, str) or chat_id < 0
+        rate = OUTBOUND_GROUP_RATE if is_group else OUTBOUND_CHAT_RATE
+        bucket = _chat_buckets[chat_id] = TokenBucket(rate, OUTBOUND_CHAT_BURST)
+    return bucket
+
+
+def _coalesce_key(method, chat_id) -> tuple | None:
+    if isinstance(method, EDIT_METHODS):
+        # Правки одного сообщения всегда вытесняют друг друга: важна только последняя
+        return (type(method).__name__, chat_id, method.message_id, method.inline_message_id)
+    tag = _coalesce_tag.get()
+    if tag is None or chat_id is None:
+        return None
+    return (tag, chat_id)
+
+
+def _enqueue(job: Job):
+    pending = _pending.get(job.key) if job.key is not None else None
+    if pending is not None:
+        pending.method = job.method
+        pending.make_request = job.make_request
+        pending.futures.extend(job.futures)
+        coalesced_total.inc(len(job.futures))
+        if job.priority < pending.priority:
+            pending.priority = job.priority
+            heapq.heapify(_heap)
+        return
+
+    if job.key is not None:
+        _pending[job.key] = job
+    heapq.heappush(_heap, job)
+    _wakeup.set()
+
+
+def _requeue(job: Job):
+    # Пока ждали retry_after, могло прийти более свежее сообщение — тогда отправится только оно
+    newer = _pending.get(job.key) if job.key is not None else None
+    if newer is not None:
+        newer.futures.extend(job.futures)
+        coalesced_total.inc(len(job.futures))
+        return
+
+    if job.key is not None:
+        _pending[job.key] = job
+    heapq.heappush(_heap, job)
+    _wakeup.set()
+
+
+def _pick() -> tuple[Job | None, float | None]:
+    # Самый приоритетный запрос из чата, который сейчас можно писать
+    skipped = []
+    job = None
+    wait = None
+    while _heap:
+        candidate = heapq.heappop(_heap)
+        if candidate.chat_id is not None:
+            if candidate.chat_id in _busy_chats:
+                skipped.append(candidate)
+                continue
+            delay = _chat_bucket(candidate.chat_id).delay()
+            if delay > 0:
+                skipped.append(candidate)
+                wait = delay if wait is None else min(wait, delay)
+                continue
+        job = candidate
+        break
+
+    for candidate in skipped:
+        heapq.heappush(_heap, candidate)
+
+    if job is not None:
+        if job.key is not None:
+            _pending.pop(job.key, None)
+        if job.chat_id is not None:
+            _chat_bucket(job.chat_id).try_acquire()
+            _busy_chats.add(job.chat_id)
+    return job, wait
+
+
+async def _send(job: Job, semaphore: asyncio.Semaphore):
+    label = PRIORITY_NAMES[job.priority]
+    queue_wait_seconds.observe(time.perf_counter() - job.enqueued_at, priority=label)
+    try:
+        result = await job.make_request(job.bot, job.method)
+    except TelegramRetryAfter as e:
+        if job.chat_id is not None:
+            _chat_bucket(job.chat_id).pause(e.retry_after)
+        else:
+            _global_bucket.pause(e.retry_after)
+
+        if job.attempts < OUTBOUND_MAX_RETRIES:
+            job.attempts += 1
+            retries_total.inc(priority=label)
+            _requeue(job)
+            return
+        _resolve(job, exception=e)
+    except Exception as e:
+        _resolve(job, exception=e)
+    else:
+        send_seconds.observe(time.perf_counter() - job.enqueued_at, priority=label)
+        _resolve(job, result=result)
+    finally:
+        _busy_chats.discard(job.chat_id)
+        semaphore.release()
+        _wakeup.set()
+
+
+def _resolve(job: Job, result=None, exception: BaseException | None = None):
+    for future in job.futures:
+        if future.done():
+            continue
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+
+async def _run():
+    semaphore = asyncio.Semaphore(OUTBOUND_CONCURRENCY)
+    while True:
+        _sweeper.sweep(time.monotonic())
+        # Сначала ждём общий лимит и свободный слот, и только потом выбираем запрос:
+        # пришедшее за время ожидания более приоритетное сообщение не застрянет за уже взятым
+        await semaphore.acquire()
+        global_wait = _global_bucket.delay()
+        if global_wait > 0:
+            semaphore.release()
+            await asyncio.sleep(global_wait)
+            continue
+
+        job, wait = _pick()
+        if job is None:
+            semaphore.release()
+            _wakeup.clear()
+            try:
+                await asyncio.wait_for(_wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        _global_bucket.try_acquire()
+        asyncio.create_task(_send(job, semaphore))
+
+
+def _log_detached_failure(future: asyncio.Future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.warning("Failed to deliver a coalesced message", exc_info=future.exception())
+
+
+async def submit(make_request, bot: Bot, method):
+    global _task
+    if _task is None or _task.done():
+        _task = asyncio.create_task(_run())
+
+    chat_id = getattr(method, "chat_id", None)
+    job = Job(_priority.get(), chat_id, _coalesce_key(method, chat_id), method, make_request, bot)
+    future = asyncio.get_running_loop().create_future()
+    job.futures.append(future)
+    _enqueue(job)
+
+    if _coalesce_tag.get() is not None and job.key is not None and job.priority == PRIORITIES["interactive"]:
+        # Ответ на тап всё равно может вытесниться более свежим — хендлер и воркер вебхука не держим
+        future.add_done_callback(_log_detached_failure)
+        return None
+    return await future
+
+
+async def stop(timeout: float = 5):
+    # Даём отправиться тому, что уже в очереди, но не ждём вечно
+    deadline = time.monotonic() + timeout
+    while (_heap or _busy_chats) and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    if _task is not None:
+        _task.cancel()
+
+
+# -------- ПОДКЛЮЧЕНИЕ --------
+class OutboundMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot: Bot, method):
+        if not isinstance(method, PACED_METHODS):
+            return await make_request(bot, method)
+        return await submit(make_request, bot, method)
+
+
+class PriorityMiddleware(BaseMiddleware):
+    # Хендлеры админки помечаются flags={"outbound": "admin"}
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        name = get_flag(data, "outbound")
+        if name is None:
+            return await handler(event, data)
+        with priority(name):
+            return await handler(event, data)
+
+
+def install(dp: Dispatcher, bot: Bot):
+    # Подключается раньше метрик: время вызова Bot API не включает ожидание в очереди
+    bot.session.middleware(OutboundMiddleware())
+    dp.message.middleware(PriorityMiddleware())
+    dp.callback_query.middleware(PriorityMiddleware())
@@ -0,0 +1,162 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware, Bot
+from aiogram.types import TelegramObject
+from sqlalchemy import func, select, update
+
+from database import AsyncSessionLocal, User
+from replica import read_session
+
+
+PLAYER_NAMES_SIZE = int(os.getenv("PLAYER_NAMES_SIZE", "50000"))
+UNKNOWN_PLAYER_TTL = 60
+
+_names: OrderedDict[int, tuple[str | None, str | None]] = OrderedDict()
+_ids_by_username: dict[str, int] = {}
+# Игроки без строки в базе: до /start не пишем их имя на каждый апдейт
+_unknown: OrderedDict[int, float] = OrderedDict()
+
+
+def _forget_username(user_id: int, username: str | None):
+    if username and _ids_by_username.get(username.lower()) == user_id:
+        del _ids_by_username[username.lower()]
+
+
+def _remember(user_id: int, username: str | None, first_name: str | None):
+    previous = _names.pop(user_id, None)
+    if previous:
+        _forget_username(user_id, previous[0])
+    _names[user_id] = (username, first_name)
+    if username:
+        _ids_by_username[username.lower()] = user_id
+
+    while len(_names) > PLAYER_NAMES_SIZE:
+        evicted_id, (evicted_username, _) = _names.popitem(last=False)
+        _forget_username(evicted_id, evicted_username)
+
+
+def _mark_unknown(user_id: int):
+    now = time.monotonic()
+    _unknown.pop(user_id, None)
+    _unknown[user_id] = now
+    # Порядок вставки совпадает с порядком времени — просроченные всегда в начале
+    while _unknown and (
+        len(_unknown) > PLAYER_NAMES_SIZE or now - next(iter(_unknown.values())) >= UNKNOWN_PLAYER_TTL
+    ):
+        _unknown.popitem(last=False)
+
+
+def format_name(user_id: int, username: str | None, first_name: str | None) -> str:
+    if username:
+        return f"@{username}"
+    if first_name:
+        return first_name
+    return f"id{user_id}"
+
+
+async def record(user_id: int, username: str | None, first_name: str | None):
+    if _names.get(user_id) == (username, first_name):
+        _names.move_to_end(user_id)
+        return
+    unknown_at = _unknown.get(user_id)
+    if unknown_at is not None and time.monotonic() - unknown_at < UNKNOWN_PLAYER_TTL:
+        return
+
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(
+            update(User)
+            .where(
+                User.user_id == user_id,
+                (User.username.is_distinct_from(username)) | (User.first_name.is_distinct_from(first_name)),
+            )
+            .values(username=username, first_name=first_name)
+        )
+        # Ноль строк — имя не менялось или игрока ещё нет в базе. Во втором случае имя не запоминаем
+        # и какое-то время не проверяем: строку создаст /start, уже с именем из апдейта
+        stored = result.rowcount > 0 or await session.scalar(
+            select(User.user_id).where(User.user_id == user_id)
+        ) is not None
+        await session.commit()
+
+    if stored:
+        _unknown.pop(user_id, None)
+        _remember(user_id, username, first_name)
+    else:
+        _mark_unknown(user_id)
+
+
+class PlayerDirectoryMiddleware(BaseMiddleware):
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        if user is not None and not user.is_bot:
+            await record(user.id, user.username, user.first_name)
+        return await handler(event, data)
+
+
+async def _fetch_chat(bot: Bot, user_id: int) -> tuple[str | None, str | None] | None:
+    try:
+        chat = await bot.get_chat(user_id)
+    except Exception:
+        return None
+    return chat.username, chat.first_name
+
+
+async def resolve_names(bot: Bot, user_ids: list[int]) -> dict[int, str]:
+    missing = [user_id for user_id in user_ids if user_id not in _names]
+
+    if missing:
+        async with read_session() as session:
+            result = await session.execute(
+                select(User.user_id, User.username, User.first_name).where(
+                    User.user_id.in_(missing),
+                    (User.username.is_not(None)) | (User.first_name.is_not(None)),
+                )
+            )
+            for user_id, username, first_name in result.all():
+                _remember(user_id, username, first_name)
+
+    missing = [user_id for user_id in missing if user_id not in _names]
+    if missing:
+        # Только тех, кого нет ни в памяти, ни в базе, спрашиваем у Telegram — параллельно
+        chats = await asyncio.gather(*(_fetch_chat(bot, user_id) for user_id in missing))
+        for user_id, chat in zip(missing, chats):
+            if chat is not None:
+                await record(user_id, *chat)
+
+    return {
+        user_id: format_name(user_id, *_names.get(user_id, (None, None)))
+        for user_id in user_ids
+    }
+
+
+async def find_user_id(bot: Bot, username: str) -> int | None:
+    cleaned = username.strip().lstrip("@")
+    if not cleaned:
+        return None
+
+    user_id = _ids_by_username.get(cleaned.lower())
+    if user_id is not None:
+        return user_id
+
+    async with AsyncSessionLocal() as session:
+        user_id = await session.scalar(
+            select(User.user_id).where(func.lower(User.username) == cleaned.lower()).limit(1)
+        )
+    if user_id is not None:
+        return user_id
+
+    try:
+        chat = await bot.get_chat(f"@{cleaned}")
+    except Exception:
+        return None
+    await record(chat.id, chat.username, chat.first_name)
+    return chat.id
@@ -0,0 +1,43 @@
+import asyncio
+import time
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, cost: float = 1) -> float:
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        self._refill(now)
+        if self.tokens >= cost:
+            return 0.0
+        return (cost - self.tokens) / self.rate
+
+    def try_acquire(self, cost: float = 1) -> bool:
+        if self.delay(cost) > 0:
+            return False
+        self.tokens -= cost
+        return True
+
+    async def acquire(self, cost: float = 1):
+        while True:
+            wait = self.delay(cost)
+            if wait <= 0:
+                self.tokens -= cost
+                return
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds: float):
+        # Telegram прислал retry_after: никто не отправляет, пока пауза не закончится
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
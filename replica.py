@@ -0,0 +1,146 @@
+import asyncio
+import logging
+import os
+import time
+
+from sqlalchemy import event, text
+from sqlalchemy.exc import DBAPIError
+
+from database import AsyncSessionLocal, ReplicaSessionLocal, replica_engine
+
+
+REPLICA_MAX_LAG_SECONDS = float(os.getenv("REPLICA_MAX_LAG_SECONDS", "10"))
+REPLICA_CHECK_INTERVAL_SECONDS = 2
+
+# Реплика, проигравшая всё полученное по живому потоку, не отстаёт; иначе отставание —
+# возраст последней проигранной транзакции. NULL (ещё ничего не проигрывала) — недоступна
+LAG_QUERY = text(
+    "SELECT CASE "
+    "WHEN NOT pg_is_in_recovery() THEN 0 "
+    "WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() "
+    "AND EXISTS (SELECT 1 FROM pg_stat_wal_receiver WHERE status = 'streaming') THEN 0 "
+    "ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp()) END"
+)
+
+logger = logging.getLogger(__name__)
+
+lag_seconds: float | None = None
+checked_at = 0.0
+reads = {"replica": 0, "primary": 0, "fallback": 0}
+_check_task: asyncio.Task | None = None
+
+
+if replica_engine is not None:
+    @event.listens_for(replica_engine.sync_engine, "handle_error")
+    def _on_replica_error(context):
+        # Реплика пропала — следующие чтения сразу идут в основную базу, не дожидаясь проверки
+        global lag_seconds
+        if context.is_disconnect:
+            lag_seconds = None
+
+
+def available() -> bool:
+    # Проверка тоже должна быть свежей: зависший цикл не должен держать чтения на отставшей реплике
+    return (
+        ReplicaSessionLocal is not None
+        and lag_seconds is not None
+        and lag_seconds <= REPLICA_MAX_LAG_SECONDS
+        and time.monotonic() - checked_at < 3 * REPLICA_CHECK_INTERVAL_SECONDS
+    )
+
+
+def _mark_unavailable():
+    global lag_seconds
+    if lag_seconds is not None:
+        logger.warning("Read replica query failed, reading from primary until the next check", exc_info=True)
+    lag_seconds = None
+
+
+class FallbackSession:
+    # Сессия реплики: запрос, упавший на ней (обрыв соединения, конфликт восстановления),
+    # один раз повторяется в основной базе, а реплика до следующей проверки считается недоступной
+    def __init__(self):
+        self._session = ReplicaSessionLocal()
+        self._fallback = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._session.close()
+        if self._fallback is not None:
+            await self._fallback.close()
+
+    async def _run(self, name: str, *args, **kwargs):
+        if self._fallback is None:
+            try:
+                return await getattr(self._session, name)(*args, **kwargs)
+            except (DBAPIError, OSError):
+                _mark_unavailable()
+                reads["fallback"] += 1
+                self._fallback = AsyncSessionLocal()
+        return await getattr(self._fallback, name)(*args, **kwargs)
+
+    async def execute(self, *args, **kwargs):
+        return await self._run("execute", *args, **kwargs)
+
+    async def scalar(self, *args, **kwargs):
+        return await self._run("scalar", *args, **kwargs)
+
+    async def scalars(self, *args, **kwargs):
+        return await self._run("scalars", *args, **kwargs)
+
+
+def read_session():
+    # Для чтений, которым не страшно отставание до REPLICA_MAX_LAG_SECONDS
+    if available():
+        reads["replica"] += 1
+        return FallbackSession()
+    reads["primary"] += 1
+    return AsyncSessionLocal()
+
+
+async def check():
+    global lag_seconds, checked_at
+    was_available = available()
+    try:
+        async with replica_engine.connect() as conn:
+            lag = await conn.scalar(LAG_QUERY)
+        lag_seconds = None if lag is None else max(float(lag), 0.0)
+    except Exception:
+        lag_seconds = None
+    checked_at = time.monotonic()
+
+    if was_available and not available():
+        logger.warning("Read replica unavailable or lagging (lag=%s), reading from primary", lag_seconds)
+    elif available() and not was_available:
+        logger.info("Read replica in use (lag=%.1fs)", lag_seconds)
+
+
+async def _check_loop():
+    while True:
+        await check()
+        await asyncio.sleep(REPLICA_CHECK_INTERVAL_SECONDS)
+
+
+def stats() -> dict:
+    return {
+        "configured": replica_engine is not None,
+        "available": available(),
+        "lag_seconds": lag_seconds,
+        "max_lag_seconds": REPLICA_MAX_LAG_SECONDS,
+        "reads": dict(reads),
+    }
+
+
+async def start():
+    global _check_task
+    if replica_engine is not None:
+        _check_task = asyncio.create_task(_check_loop())
+
+
+async def stop():
+    if _check_task is not None:
+        _check_task.cancel()
+    if replica_engine is not None:
+        await replica_engine.dispose()
@@ -0,0 +1,99 @@
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware, Dispatcher
+from aiogram.dispatcher.event.handler import CallableObject
+from aiogram.dispatcher.flags import get_flag as get_handler_flag
+from aiogram.types import Message
+
+
+class Route:
+    __slots__ = ("name", "handler", "flags")
+
+    def __init__(self, callback: Callable, flags: dict | None):
+        self.name = callback.__name__
+        self.handler = CallableObject(callback)
+        self.flags = flags or {}
+
+
+class TextRouter:
+    # Кнопки меню и незавершённые вводы находятся одним поиском в словаре, а не перебором фильтров
+    def __init__(self, state):
+        self.state = state
+        self.texts: dict[str, Route] = {}
+        self.inputs: dict[str, Route] = {}
+
+    def text(self, text: str, flags: dict | None = None):
+        def register(callback):
+            self.texts[text] = Route(callback, flags)
+            return callback
+        return register
+
+    def input(self, state: str, flags: dict | None = None):
+        def register(callback):
+            self.inputs[state] = Route(callback, flags)
+            return callback
+        return register
+
+    def get_state(self, user_id: int) -> dict | None:
+        return self.state.get(user_id)
+
+    async def set_state(self, user_id: int, state: str, data: dict | None = None):
+        await self.state.put(user_id, {"state": state, **(data or {})})
+
+    async def clear_state(self, user_id: int):
+        await self.state.discard(user_id)
+
+    def resolve(self, message: Message) -> Route | None:
+        text = message.text
+        if text is None:
+            return None
+
+        route = self.texts.get(text)
+        if route is not None:
+            return route
+
+        # Команды не считаются ответом на запрос ввода
+        if text.startswith("/") or message.from_user is None:
+            return None
+        current = self.state.get(message.from_user.id)
+        if current is None:
+            return None
+        return self.inputs.get(current["state"])
+
+
+class RoutingMiddleware(BaseMiddleware):
+    def __init__(self, router: TextRouter):
+        self.router = router
+
+    async def __call__(
+        self,
+        handler: Callable[[Message, dict[str, Any]], Awaitable[Any]],
+        event: Message,
+        data: dict[str, Any],
+    ) -> Any:
+        route = self.router.resolve(event)
+        if route is not None:
+            data["route"] = route
+        return await handler(event, data)
+
+
+def has_route(message: Message, route: Route | None = None) -> bool:
+    return route is not None
+
+
+async def dispatch(message: Message, route: Route, **data):
+    return await route.handler.call(message, **data)
+
+
+def get_flag(data: dict[str, Any], name: str, default=None):
+    # Флаги маршрута (throttle, outbound) видны middleware так же, как флаги обычного хендлера
+    route = data.get("route")
+    if route is not None:
+        return route.flags.get(name, default)
+    return get_handler_flag(data, name, default=default)
+
+
+def install(dp: Dispatcher, router: TextRouter):
+    # Должен быть первым хендлером сообщений: маршрут уже найден, остальные фильтры не проверяются
+    dp.message.outer_middleware(RoutingMiddleware(router))
+    dp.message.register(dispatch, has_route)
@@ -0,0 +1,193 @@
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+from typing import Any
+
+from sqlalchemy import text
+
+from database import AsyncSessionLocal, engine
+from listener import Listener
+
+
+STATE_STORE = os.getenv("STATE_STORE", "memory")
+STATE_PURGE_INTERVAL = 60
+STATE_CHANNEL = "bot_state"
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class InMemoryStateStore:
+    def __init__(self):
+        self._entries: dict[tuple[str, int], tuple[Any, float | None]] = {}
+        self._purge_task: asyncio.Task | None = None
+
+    def _put_local(self, namespace: str, key: int, value: Any, expires_at: float | None):
+        self._entries[(namespace, key)] = (value, expires_at)
+
+    def get(self, namespace: str, key: int, default=None):
+        entry = self._entries.get((namespace, key))
+        if entry is None:
+            return default
+
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= time.time():
+            self._entries.pop((namespace, key), None)
+            return default
+        return value
+
+    def contains(self, namespace: str, key: int) -> bool:
+        return self.get(namespace, key, _MISSING) is not _MISSING
+
+    async def set(self, namespace: str, key: int, value: Any = True, ttl: float | None = None):
+        expires_at = time.time() + ttl if ttl is not None else None
+        self._put_local(namespace, key, value, expires_at)
+
+    async def delete(self, namespace: str, key: int):
+        self._entries.pop((namespace, key), None)
+
+    async def purge(self):
+        now = time.time()
+        expired = [
+            entry_key
+            for entry_key, (_, expires_at) in self._entries.items()
+            if expires_at is not None and expires_at <= now
+        ]
+        for entry_key in expired:
+            self._entries.pop(entry_key, None)
+
+    async def _purge_loop(self):
+        while True:
+            await asyncio.sleep(STATE_PURGE_INTERVAL)
+            try:
+                await self.purge()
+            except Exception:
+                logger.exception("Failed to purge expired state")
+
+    async def start(self):
+        self._purge_task = asyncio.create_task(self._purge_loop())
+
+    async def stop(self):
+        if self._purge_task is not None:
+            self._purge_task.cancel()
+
+
+class PostgresStateStore(InMemoryStateStore):
+    # Чтения идут из локальной копии, записи — в UNLOGGED-таблицу с NOTIFY для остальных реплик
+    def __init__(self):
+        super().__init__()
+        self._instance_id = uuid.uuid4().hex
+        self._listener = Listener(STATE_CHANNEL, self._on_notify, self._load)
+
+    async def _load(self):
+        # Вся таблица целиком: при старте и после обрыва LISTEN, когда уведомления могли потеряться
+        async with engine.begin() as conn:
+            result = await conn.execute(
+                text(
+                    "SELECT namespace, key, value, expires_at FROM bot_state "
+                    "WHERE expires_at IS NULL OR expires_at > :now"
+                ),
+                {"now": time.time()},
+            )
+            rows = result.all()
+        self._entries = {
+            (namespace, key): (json.loads(value), expires_at)
+            for namespace, key, value, expires_at in rows
+        }
+
+    async def start(self):
+        # Таблица bot_state создаётся миграцией
+        await self._load()
+        await self._listener.start()
+        await super().start()
+
+    async def stop(self):
+        await super().stop()
+        await self._listener.stop()
+
+    def _on_notify(self, connection, pid, channel, payload: str):
+        instance_id, namespace, key = payload.rsplit(":", 2)
+        if instance_id != self._instance_id:
+            asyncio.create_task(self._reload(namespace, int(key)))
+
+    async def _reload(self, namespace: str, key: int):
+        async with AsyncSessionLocal() as session:
+            result = await session.execute(
+                text("SELECT value, expires_at FROM bot_state WHERE namespace = :namespace AND key = :key"),
+                {"namespace": namespace, "key": key},
+            )
+            row = result.one_or_none()
+
+        if row is None:
+            self._entries.pop((namespace, key), None)
+        else:
+            self._put_local(namespace, key, json.loads(row.value), row.expires_at)
+
+    async def _notify(self, session, namespace: str, key: int):
+        await session.execute(
+            text("SELECT pg_notify(:channel, :payload)"),
+            {"channel": STATE_CHANNEL, "payload": f"{self._instance_id}:{namespace}:{key}"},
+        )
+
+    async def set(self, namespace: str, key: int, value: Any = True, ttl: float | None = None):
+        await super().set(namespace, key, value, ttl)
+        _, expires_at = self._entries[(namespace, key)]
+
+        async with AsyncSessionLocal() as session:
+            await session.execute(
+                text(
+                    "INSERT INTO bot_state (namespace, key, value, expires_at) "
+                    "VALUES (:namespace, :key, :value, :expires_at) "
+                    "ON CONFLICT (namespace, key) DO UPDATE "
+                    "SET value = EXCLUDED.value, expires_at = EXCLUDED.expires_at"
+                ),
+                {"namespace": namespace, "key": key, "value": json.dumps(value), "expires_at": expires_at},
+            )
+            await self._notify(session, namespace, key)
+            await session.commit()
+
+    async def delete(self, namespace: str, key: int):
+        await super().delete(namespace, key)
+
+        async with AsyncSessionLocal() as session:
+            await session.execute(
+                text("DELETE FROM bot_state WHERE namespace = :namespace AND key = :key"),
+                {"namespace": namespace, "key": key},
+            )
+            await self._notify(session, namespace, key)
+            await session.commit()
+
+    async def purge(self):
+        await super().purge()
+        async with AsyncSessionLocal() as session:
+            await session.execute(
+                text("DELETE FROM bot_state WHERE expires_at <= :now"),
+                {"now": time.time()},
+            )
+            await session.commit()
+
+
+class Namespace:
+    def __init__(self, name: str, ttl: float | None = None):
+        self.name = name
+        self.ttl = ttl
+
+    def __contains__(self, key: int) -> bool:
+        return store.contains(self.name, key)
+
+    def get(self, key: int, default=None):
+        return store.get(self.name, key, default)
+
+    async def put(self, key: int, value: Any = True):
+        await store.set(self.name, key, value, self.ttl)
+
+    async def discard(self, key: int):
+        if key in self:
+            await store.delete(self.name, key)
+
+
+store = PostgresStateStore() if STATE_STORE == "postgres" else InMemoryStateStore()
@@ -0,0 +1,18 @@
+import time
+
+
+class IdleSweeper:
+    # Чистит словарь от простаивающих записей не чаще раза в interval секунд,
+    # чтобы не обходить его на каждом апдейте
+    def __init__(self, entries: dict, interval: float, is_idle):
+        self.entries = entries
+        self.interval = interval
+        self.is_idle = is_idle
+        self._swept_at = time.monotonic()
+
+    def sweep(self, now: float):
+        if now - self._swept_at < self.interval:
+            return
+        self._swept_at = now
+        for key in [key for key, value in self.entries.items() if self.is_idle(key, value, now)]:
+            del self.entries[key]
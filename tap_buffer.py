@@ -0,0 +1,362 @@
+import asyncio
+import glob
+import json
+import logging
+import os
+import time
+import uuid
+from datetime import datetime
+
+from sqlalchemy import BigInteger, Integer, cast, column, func, select, text, update, values
+
+import game
+import ledger
+import user_cache
+from database import AsyncSessionLocal, User
+
+
+TAP_WRITE_BEHIND = os.getenv("TAP_WRITE_BEHIND", "0") == "1"
+TAP_FLUSH_INTERVAL_MS = int(os.getenv("TAP_FLUSH_INTERVAL_MS", "500"))
+TAP_JOURNAL_PATH = os.getenv("TAP_JOURNAL_PATH", "tap_journal.log")
+TAP_STATE_IDLE_SECONDS = int(os.getenv("TAP_STATE_IDLE_SECONDS", "120"))
+TAP_FLUSH_CHUNK = 1000
+
+logger = logging.getLogger(__name__)
+
+
+class TapState:
+    # Снимок игрока для ответа без базы; в базу уходят только дельты из _pending
+    __slots__ = (
+        "balance",
+        "energy",
+        "max_energy",
+        "tap_power",
+        "energy_regen",
+        "auto_farm_level",
+        "auto_farm_enabled",
+        "last_energy_update",
+        "last_farm_update",
+        "touched_at",
+    )
+
+    def __init__(self, user: user_cache.CachedUser):
+        self.balance = user.balance
+        self.energy = user.energy
+        self.max_energy = user.max_energy
+        self.tap_power = user.tap_power
+        self.energy_regen = user.energy_regen
+        self.auto_farm_level = user.auto_farm_level
+        self.auto_farm_enabled = user.auto_farm_enabled
+        self.last_energy_update = user.last_energy_update
+        self.last_farm_update = user.last_farm_update
+        self.touched_at = time.monotonic()
+
+
+_states: dict[int, TapState] = {}
+# Монеты за тапы, ещё не записанные в базу; столько же энергии потрачено
+_pending: dict[int, int] = {}
+_journal_file = None
+_journal_id: str | None = None
+_journal_segment = 0
+# Id сегментов журнала, тапы из которых ещё не записаны
+_unwritten_segments: list[str] = []
+# Игроки из пачки, которую flush пишет прямо сейчас
+_in_flight: set[int] = set()
+_flush_lock = asyncio.Lock()
+_flush_task: asyncio.Task | None = None
+
+
+# -------- ЖУРНАЛ --------
+def _segment_paths() -> list[str]:
+    paths = glob.glob(f"{glob.escape(TAP_JOURNAL_PATH)}.*")
+    return sorted(
+        (p for p in paths if p.rsplit(".", 1)[-1].isdigit()),
+        key=lambda p: int(p.rsplit(".", 1)[-1]),
+    )
+
+
+def _open_journal():
+    # Первая строка — id сегмента: он записывается в базу вместе с тапами, и повторный проигрыш его пропустит
+    global _journal_file, _journal_id
+    _journal_id = uuid.uuid4().hex
+    _journal_file = open(TAP_JOURNAL_PATH, "a", encoding="utf-8")
+    _journal_file.write(json.dumps({"segment": _journal_id}) + "\n")
+    _journal_file.flush()
+
+
+def _journal(user_id: int, delta: int, write_id: str | None = None):
+    # Строка с write_id при проигрывании учитывается, только если этот id записан в базу
+    if _journal_file is None:
+        return
+    entry = [user_id, delta] if write_id is None else [user_id, delta, write_id]
+    _journal_file.write(json.dumps(entry) + "\n")
+    _journal_file.flush()
+
+
+def _rotate_journal():
+    # Текущий журнал уходит в пронумерованный сегмент, новые тапы пишутся в свежий файл
+    global _journal_segment
+    if _journal_file is None:
+        return
+    _journal_file.close()
+    _journal_segment += 1
+    os.replace(TAP_JOURNAL_PATH, f"{TAP_JOURNAL_PATH}.{_journal_segment}")
+    _unwritten_segments.append(_journal_id)
+    _open_journal()
+
+
+def _read_journal(path: str) -> tuple[str | None, dict[int, int], list[tuple[str, int, int]]]:
+    segment = None
+    pending: dict[int, int] = {}
+    conditional: list[tuple[str, int, int]] = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Недописанная строка при падении процесса
+                continue
+            if isinstance(entry, dict):
+                segment = entry.get("segment")
+                continue
+            if len(entry) > 2:
+                conditional.append((entry[2], entry[0], entry[1]))
+                continue
+            user_id, delta = entry[:2]
+            pending[user_id] = pending.get(user_id, 0) + delta
+    return segment, pending, conditional
+
+
+# -------- ЗАПИСЬ В БАЗУ --------
+async def _write_batch(batch: list[tuple[int, int]], segments: list[str]):
+    # Пишем дельтой к текущей строке: энергию, потраченную в другом процессе или через веб, не затираем.
+    # Засчитывается не больше тапов, чем хватает энергии в базе
+    credited = []
+    async with AsyncSessionLocal() as session:
+        for start in range(0, len(batch), TAP_FLUSH_CHUNK):
+            taps = values(
+                column("user_id", BigInteger),
+                column("delta", Integer),
+                name="taps",
+            ).data(batch[start:start + TAP_FLUSH_CHUNK])
+            # Фарм и засчитанные тапы считаются под блокировкой строк — для журнала баланса, как в game._apply
+            before = (
+                select(
+                    User.user_id,
+                    game.farm_earned().label("farm"),
+                    cast(func.least(taps.c.delta, func.floor(game.current_energy())), Integer).label("tapped"),
+                )
+                .where(User.user_id == taps.c.user_id)
+                .with_for_update(of=User)
+                .subquery()
+            )
+            catch_up = game.farm_catch_up()
+            result = await session.execute(
+                update(User)
+                .where(User.user_id == before.c.user_id)
+                .values(
+                    balance=catch_up["balance"] + before.c.tapped,
+                    last_farm_update=catch_up["last_farm_update"],
+                    energy=game.current_energy() - before.c.tapped,
+                    last_energy_update=game.sql_now(),
+                )
+                .returning(User.user_id, before.c.farm, before.c.tapped)
+            )
+            credited.extend(result.all())
+        if segments:
+            await session.execute(
+                text("INSERT INTO tap_journal_segments (segment) VALUES (:segment) ON CONFLICT DO NOTHING"),
+                [{"segment": segment} for segment in segments],
+            )
+        await session.commit()
+
+    for user_id, farm, tapped in credited:
+        ledger.record(user_id, farm, "farm")
+        ledger.record(user_id, tapped, "tap")
+
+
+def _evict_idle():
+    now = time.monotonic()
+    for user_id in [u for u, state in _states.items() if now - state.touched_at >= TAP_STATE_IDLE_SECONDS]:
+        if user_id not in _pending:
+            del _states[user_id]
+
+
+async def flush():
+    async with _flush_lock:
+        await _flush_locked()
+
+
+async def _flush_locked():
+    if not _pending:
+        _evict_idle()
+        return
+
+    batch = list(_pending.items())
+    _pending.clear()
+    _rotate_journal()
+    rotated = _journal_segment
+    segments = _unwritten_segments[:]
+
+    _in_flight.update(user_id for user_id, _ in batch)
+    try:
+        await _write_batch(batch, segments)
+    except Exception:
+        # Возвращаем дельты в память, сегменты журнала остаются на диске до успешной записи
+        for user_id, delta in batch:
+            _pending[user_id] = _pending.get(user_id, 0) + delta
+        raise
+    finally:
+        _in_flight.clear()
+
+    del _unwritten_segments[:len(segments)]
+    user_cache.announce(user_id for user_id, _ in batch)
+    for path in _segment_paths():
+        if int(path.rsplit(".", 1)[-1]) <= rotated:
+            os.remove(path)
+    _evict_idle()
+
+
+async def _flush_loop():
+    while True:
+        await asyncio.sleep(TAP_FLUSH_INTERVAL_MS / 1000)
+        try:
+            await flush()
+        except Exception:
+            logger.exception("Failed to flush buffered taps")
+
+
+# -------- ТАПЫ --------
+def _forget(user_id: int):
+    # Игрок изменён в обход буфера: снимок перечитаем, незаписанные дельты остаются в _pending
+    _states.pop(user_id, None)
+
+
+user_cache.invalidation_observers.append(_forget)
+
+
+async def _load(user_id: int) -> TapState | None:
+    user = await user_cache.get(user_id)
+    if user is None:
+        return None
+    state = TapState(user)
+    pending = _pending.get(user_id, 0)
+    state.balance += pending
+    state.energy -= pending
+    return _states.setdefault(user_id, state)
+
+
+async def tap(user_id: int, count: int = 1) -> tuple[TapState | None, bool]:
+    state = _states.get(user_id)
+    if state is None:
+        state = await _load(user_id)
+        if state is None:
+            return None, False
+
+    # Фарм в памяти — только для показа баланса; в базе его начислит запись или фоновое начисление
+    now = datetime.utcnow()
+    game.settle(state, now)
+    state.touched_at = time.monotonic()
+
+    tapped = state.energy >= state.tap_power
+    if tapped:
+        delta = game.affordable_taps(state.energy, state.tap_power, count) * state.tap_power
+        state.energy -= delta
+        state.balance += delta
+        _pending[user_id] = _pending.get(user_id, 0) + delta
+        _journal(user_id, delta)
+
+    user_cache.store_game_state(user_id, state)
+    return state, tapped
+
+
+async def settle(user_id: int) -> bool:
+    # Перед любым другим изменением игрока пишем только его накопленные тапы и забываем его снимок;
+    # остальных игроков запишет очередной flush
+    if user_id not in _states and user_id not in _pending:
+        return False
+
+    if user_id in _in_flight:
+        # Его тапы уже пишет flush — дожидаемся, чтобы следующий запрос увидел их в базе
+        async with _flush_lock:
+            pass
+
+    delta = _pending.pop(user_id, 0)
+    if delta:
+        # Дельта уже лежит в журнале: компенсирующая строка с id этой записи не даст проиграть её повторно
+        write_id = uuid.uuid4().hex
+        _journal(user_id, -delta, write_id)
+        try:
+            await _write_batch([(user_id, delta)], [write_id])
+        except Exception:
+            _pending[user_id] = _pending.get(user_id, 0) + delta
+            raise
+        user_cache.announce([user_id])
+
+    # Тап, пришедший во время записи, оставит дельту в _pending, и снимок игрока останется до flush
+    if user_id not in _pending:
+        _states.pop(user_id, None)
+    return True
+
+
+# -------- ЗАПУСК --------
+async def start():
+    global _flush_task, _journal_segment
+    if not TAP_WRITE_BEHIND:
+        return
+
+    paths = _segment_paths()
+    if os.path.exists(TAP_JOURNAL_PATH):
+        paths.append(TAP_JOURNAL_PATH)
+    if paths:
+        journals = [_read_journal(path) for path in paths]
+        async with AsyncSessionLocal() as session:
+            await session.execute(text(
+                "DELETE FROM tap_journal_segments WHERE applied_at < (now() AT TIME ZONE 'utc') - interval '7 days'"
+            ))
+            ids = [segment for segment, _, _ in journals if segment is not None]
+            ids += [write_id for _, _, conditional in journals for write_id, _, _ in conditional]
+            written = set(await session.scalars(
+                text("SELECT segment FROM tap_journal_segments WHERE segment = ANY(:segments)"),
+                {"segments": ids},
+            ))
+            await session.commit()
+
+        # Сегменты, записанные до падения (процесс не успел удалить файл), второй раз не проигрываем.
+        # Компенсации settle учитываем, только если их запись успела закоммититься
+        pending: dict[int, int] = {}
+        segments = []
+        for segment, deltas, conditional in journals:
+            if segment in written:
+                continue
+            if segment is not None:
+                segments.append(segment)
+            for user_id, delta in deltas.items():
+                pending[user_id] = pending.get(user_id, 0) + delta
+            for write_id, user_id, delta in conditional:
+                if write_id in written:
+                    pending[user_id] = pending.get(user_id, 0) + delta
+        if pending or segments:
+            await _write_batch([(user_id, delta) for user_id, delta in pending.items() if delta > 0], segments)
+        for path in paths:
+            os.remove(path)
+    _journal_segment = 0
+
+    _open_journal()
+    _flush_task = asyncio.create_task(_flush_loop())
+
+
+async def stop():
+    global _journal_file
+    if not TAP_WRITE_BEHIND:
+        return
+
+    if _flush_task is not None:
+        _flush_task.cancel()
+    await flush()
+    if _journal_file is not None:
+        _journal_file.close()
+        _journal_file = None
+        # Всё записано — в журнале остался только заголовок сегмента
+        if not _pending and os.path.exists(TAP_JOURNAL_PATH):
+            os.remove(TAP_JOURNAL_PATH)
@@ -0,0 +1,82 @@
+import asyncio
+import logging
+import os
+import time
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import InlineKeyboardMarkup
+
+from sweeper import IdleSweeper
+
+
+TAP_PANEL_EDIT_INTERVAL_MS = int(os.getenv("TAP_PANEL_EDIT_INTERVAL_MS", "1500"))
+TAP_PANEL_IDLE_SECONDS = 300
+
+logger = logging.getLogger(__name__)
+
+
+class Panel:
+    __slots__ = ("chat_id", "message_id", "text", "shown_text", "edited_at", "task")
+
+    def __init__(self, chat_id: int, message_id: int, shown_text: str | None):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.text = shown_text
+        self.shown_text = shown_text
+        self.edited_at = 0.0
+        self.task: asyncio.Task | None = None
+
+
+_panels: dict[int, Panel] = {}
+_sweeper = IdleSweeper(
+    _panels,
+    TAP_PANEL_IDLE_SECONDS,
+    lambda user_id, panel, now: panel.task is None and now - panel.edited_at > TAP_PANEL_IDLE_SECONDS,
+)
+
+
+async def _edit_later(bot: Bot, panel: Panel, delay: float, reply_markup: InlineKeyboardMarkup):
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+    # Тапы, пришедшие во время правки, запланируют следующую
+    panel.task = None
+    text = panel.text
+    if text == panel.shown_text:
+        return
+
+    panel.edited_at = time.monotonic()
+    try:
+        await bot.edit_message_text(
+            text,
+            chat_id=panel.chat_id,
+            message_id=panel.message_id,
+            reply_markup=reply_markup,
+        )
+        panel.shown_text = text
+    except TelegramBadRequest:
+        # Текст не изменился или сообщение удалено — следующий тап попробует снова
+        pass
+    except Exception:
+        # RetryAfter сюда доходит, только когда outbound исчерпал повторы
+        logger.warning("Failed to edit tap panel in chat %s", panel.chat_id, exc_info=True)
+
+
+def show(bot: Bot, user_id: int, message, text: str, reply_markup: InlineKeyboardMarkup):
+    # Правит сообщение с кнопкой не чаще раза в TAP_PANEL_EDIT_INTERVAL_MS, показывая последнее состояние
+    now = time.monotonic()
+    _sweeper.sweep(now)
+
+    panel = _panels.get(user_id)
+    if panel is None or panel.message_id != message.message_id:
+        if panel is not None and panel.task is not None:
+            panel.task.cancel()
+        panel = _panels[user_id] = Panel(message.chat.id, message.message_id, message.text)
+
+    panel.text = text
+    if panel.task is not None or text == panel.shown_text:
+        return
+
+    delay = panel.edited_at + TAP_PANEL_EDIT_INTERVAL_MS / 1000 - now
+    panel.task = asyncio.create_task(_edit_later(bot, panel, delay, reply_markup))
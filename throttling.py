@@ -0,0 +1,87 @@
+import os
+import time
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware
+from aiogram.types import CallbackQuery, Message
+
+from ratelimit import TokenBucket
+from routing import get_flag
+from sweeper import IdleSweeper
+
+
+THROTTLE_USER_RATE = float(os.getenv("THROTTLE_USER_RATE", "5"))
+THROTTLE_USER_BURST = float(os.getenv("THROTTLE_USER_BURST", "10"))
+THROTTLE_GLOBAL_RATE = float(os.getenv("THROTTLE_GLOBAL_RATE", "500"))
+THROTTLE_GLOBAL_BURST = float(os.getenv("THROTTLE_GLOBAL_BURST", "1000"))
+THROTTLE_COSTS = {"tap": 1, "upgrade": 2}
+THROTTLE_MAX_COALESCED = 1000
+THROTTLE_IDLE_SECONDS = 300
+
+
+class UserThrottle:
+    __slots__ = ("bucket", "allowed", "throttled", "coalesced", "warned", "seen_at")
+
+    def __init__(self):
+        self.bucket = TokenBucket(THROTTLE_USER_RATE, THROTTLE_USER_BURST)
+        self.allowed = 0
+        self.throttled = 0
+        self.coalesced = 0
+        self.warned = False
+        self.seen_at = time.monotonic()
+
+
+_global_bucket = TokenBucket(THROTTLE_GLOBAL_RATE, THROTTLE_GLOBAL_BURST)
+_users: dict[int, UserThrottle] = {}
+_sweeper = IdleSweeper(
+    _users, THROTTLE_IDLE_SECONDS, lambda user_id, state, now: now - state.seen_at > THROTTLE_IDLE_SECONDS
+)
+
+
+def top_throttled(limit: int = 10) -> list[tuple[int, UserThrottle]]:
+    ranked = sorted(_users.items(), key=lambda item: item[1].throttled, reverse=True)
+    return [(user_id, state) for user_id, state in ranked[:limit] if state.throttled]
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    # Хендлеры помечаются flags={"throttle": "tap"} или flags={"throttle": "upgrade"}
+    async def __call__(
+        self,
+        handler: Callable[[Message | CallbackQuery, dict[str, Any]], Awaitable[Any]],
+        event: Message | CallbackQuery,
+        data: dict[str, Any],
+    ) -> Any:
+        kind = get_flag(data, "throttle")
+        if kind is None:
+            return await handler(event, data)
+
+        now = time.monotonic()
+        _sweeper.sweep(now)
+
+        user_id = event.from_user.id
+        state = _users.get(user_id)
+        if state is None:
+            state = _users[user_id] = UserThrottle()
+        state.seen_at = now
+
+        cost = THROTTLE_COSTS.get(kind, 1)
+        if state.bucket.delay(cost) > 0 or not _global_bucket.try_acquire(cost):
+            state.throttled += 1
+            if kind == "tap":
+                # Лишние тапы не теряются, а применяются вместе со следующим разрешённым
+                state.coalesced = min(THROTTLE_MAX_COALESCED, state.coalesced + 1)
+                if isinstance(event, CallbackQuery):
+                    # Иначе кнопка так и крутится, пока Telegram не сдастся
+                    await event.answer()
+            elif not state.warned:
+                state.warned = True
+                await event.answer("⏳ Не так быстро, подожди пару секунд")
+            return None
+
+        state.bucket.try_acquire(cost)
+        state.allowed += 1
+        state.warned = False
+        if kind == "tap":
+            data["tap_count"] = 1 + state.coalesced
+            state.coalesced = 0
+        return await handler(event, data)
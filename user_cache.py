@@ -0,0 +1,236 @@
+import asyncio
+import logging
+import os
+import time
+import uuid
+from collections import OrderedDict
+
+from sqlalchemy import select, text
+
+from database import AsyncSessionLocal, User
+from listener import Listener
+
+
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "50000"))
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", "300"))
+USER_CACHE_CHANNEL = "user_cache"
+USER_CACHE_NOTIFY_INTERVAL_MS = 200
+NOTIFY_PAYLOAD_LIMIT = 7000
+
+# Якоря энергии и фарма хранятся как есть: текущие значения считает game.energy_at / balance_at
+FIELDS = (
+    "user_id",
+    "balance",
+    "energy",
+    "max_energy",
+    "tap_power",
+    "energy_regen",
+    "auto_farm_level",
+    "auto_farm_enabled",
+    "last_energy_update",
+    "last_farm_update",
+    "admin_rights",
+    "referral_code",
+    "referrals_count",
+    "referral_earned",
+)
+GAME_FIELDS = FIELDS[1:10]
+CACHE_COLUMNS = tuple(getattr(User, field) for field in FIELDS)
+
+logger = logging.getLogger(__name__)
+
+
+class CachedUser:
+    __slots__ = FIELDS + ("cached_at",)
+
+    def __init__(self, source):
+        self.update(source, FIELDS)
+
+    def update(self, source, fields: tuple = FIELDS):
+        for field in fields:
+            setattr(self, field, getattr(source, field))
+        self.cached_at = time.monotonic()
+
+
+_entries: OrderedDict[int, CachedUser] = OrderedDict()
+_instance_id = uuid.uuid4().hex
+_changed: set[int] = set()
+# Игроки, которых сейчас читают из базы, и те из них, кого за это время перезаписали
+_loading: dict[int, int] = {}
+_stale: set[int] = set()
+_notify_task: asyncio.Task | None = None
+# Вызываются с user_id, когда запись игрока в кэше заменена данными из базы (tap_buffer забывает свой снимок)
+invalidation_observers: list = []
+hits = 0
+misses = 0
+evictions = 0
+
+
+def _put(source) -> CachedUser:
+    global evictions
+    record = _entries.get(source.user_id)
+    if record is not None:
+        record.update(source)
+        _entries.move_to_end(source.user_id)
+        return record
+
+    record = _entries[source.user_id] = CachedUser(source)
+    if len(_entries) > USER_CACHE_SIZE:
+        _entries.popitem(last=False)
+        evictions += 1
+    return record
+
+
+def _notify_observers(user_id: int):
+    for observer in invalidation_observers:
+        observer(user_id)
+
+
+def _written(user_id: int):
+    # Прочитанная до этой записи строка устарела — get не положит её в кэш
+    if user_id in _loading:
+        _stale.add(user_id)
+
+
+def _changed_elsewhere(user_id: int):
+    if _listener.active:
+        _changed.add(user_id)
+
+
+async def get(user_id: int) -> CachedUser | None:
+    global hits, misses
+    record = _entries.get(user_id)
+    if record is not None and time.monotonic() - record.cached_at < USER_CACHE_TTL:
+        _entries.move_to_end(user_id)
+        hits += 1
+        return record
+
+    misses += 1
+    _loading[user_id] = _loading.get(user_id, 0) + 1
+    try:
+        async with AsyncSessionLocal() as session:
+            row = (await session.execute(select(*CACHE_COLUMNS).where(User.user_id == user_id))).one_or_none()
+    finally:
+        stale = user_id in _stale
+        if _loading[user_id] == 1:
+            del _loading[user_id]
+            _stale.discard(user_id)
+        else:
+            _loading[user_id] -= 1
+
+    if stale:
+        # Пока читали, игрока перезаписали: свежая запись уже в кэше или придёт со следующим чтением
+        record = _entries.get(user_id)
+        if record is not None:
+            return record
+        return CachedUser(row) if row is not None else None
+    if row is None:
+        _entries.pop(user_id, None)
+        return None
+    return _put(row)
+
+
+def store(source):
+    # Сквозная запись после коммита: ORM-объект или строка RETURNING с полями FIELDS
+    _put(source)
+    _written(source.user_id)
+    _notify_observers(source.user_id)
+    _changed_elsewhere(source.user_id)
+
+
+def store_game_state(user_id: int, source):
+    # Накопленные в памяти тапы (tap_buffer): обновляем только игровые поля, если игрок уже в кэше
+    _written(user_id)
+    record = _entries.get(user_id)
+    if record is not None:
+        record.update(source, GAME_FIELDS)
+
+
+def announce(user_ids):
+    # Запись сделана в обход store (пакетный UPDATE) — локальный кэш уже свежий, сообщаем остальным
+    for user_id in user_ids:
+        _changed_elsewhere(user_id)
+
+
+def stats() -> dict:
+    total = hits + misses
+    return {
+        "size": len(_entries),
+        "capacity": USER_CACHE_SIZE,
+        "hits": hits,
+        "misses": misses,
+        "evictions": evictions,
+        "hit_rate": hits / total if total else 0.0,
+    }
+
+
+# -------- ИНВАЛИДАЦИЯ МЕЖДУ ПРОЦЕССАМИ --------
+def _on_notify(connection, pid, channel, payload: str):
+    instance_id, _, user_ids = payload.partition(":")
+    if instance_id == _instance_id:
+        return
+    for user_id in map(int, user_ids.split(",")):
+        _entries.pop(user_id, None)
+        _written(user_id)
+        _notify_observers(user_id)
+
+
+async def _on_reconnect():
+    # Пока слушатель был отключён, уведомления терялись: локальным записям больше не верим
+    for user_id in list(_entries):
+        del _entries[user_id]
+        _notify_observers(user_id)
+    _stale.update(_loading)
+
+
+_listener = Listener(USER_CACHE_CHANNEL, _on_notify, _on_reconnect)
+
+
+async def _publish():
+    # Изменённые id уходят пачкой: один NOTIFY на интервал, а не на каждое действие
+    if not _changed:
+        return
+
+    user_ids = [str(user_id) for user_id in _changed]
+    _changed.clear()
+    payloads = []
+    chunk: list[str] = []
+    size = 0
+    for user_id in user_ids:
+        if size + len(user_id) + 1 > NOTIFY_PAYLOAD_LIMIT:
+            payloads.append(chunk)
+            chunk, size = [], 0
+        chunk.append(user_id)
+        size += len(user_id) + 1
+    payloads.append(chunk)
+
+    async with AsyncSessionLocal() as session:
+        for chunk in payloads:
+            await session.execute(
+                text("SELECT pg_notify(:channel, :payload)"),
+                {"channel": USER_CACHE_CHANNEL, "payload": f"{_instance_id}:{','.join(chunk)}"},
+            )
+        await session.commit()
+
+
+async def _publish_loop():
+    while True:
+        await asyncio.sleep(USER_CACHE_NOTIFY_INTERVAL_MS / 1000)
+        try:
+            await _publish()
+        except Exception:
+            logger.exception("Failed to publish user cache invalidations")
+
+
+async def start():
+    global _notify_task
+    await _listener.start()
+    _notify_task = asyncio.create_task(_publish_loop())
+
+
+async def stop():
+    if _notify_task is not None:
+        _notify_task.cancel()
+    if _listener.active:
+        await _publish()
+        await _listener.stop()
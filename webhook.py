@@ -0,0 +1,132 @@
+import asyncio
+import hmac
+import logging
+import os
+import time
+
+from aiogram import Bot, Dispatcher
+from aiohttp import web
+
+import metrics
+
+
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "16"))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "10000"))
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+logger = logging.getLogger(__name__)
+
+stats = {"received": 0, "processed": 0, "rejected": 0, "failed": 0}
+_queue: asyncio.Queue[tuple[float, dict]] | None = None
+
+
+def queue_depth() -> int:
+    return _queue.qsize() if _queue is not None else 0
+
+
+metrics.Gauge("bot_webhook_queue_depth", "Updates waiting for a worker", queue_depth)
+update_wait_seconds = metrics.Histogram("bot_webhook_queue_wait_seconds", "Time an update spends in the queue")
+
+
+async def _worker(dp: Dispatcher, bot: Bot):
+    while True:
+        received_at, data = await _queue.get()
+        update_wait_seconds.observe(time.perf_counter() - received_at)
+        try:
+            await dp.feed_raw_update(bot, data)
+            stats["processed"] += 1
+        except Exception:
+            stats["failed"] += 1
+            logger.exception("Failed to process update %s", data.get("update_id"))
+        finally:
+            _queue.task_done()
+
+
+def _authorized(request: web.Request) -> bool:
+    received = request.headers.get(SECRET_HEADER, "")
+    return hmac.compare_digest(received.encode(), WEBHOOK_SECRET.encode())
+
+
+async def handle_update(request: web.Request) -> web.Response:
+    if not _authorized(request):
+        return web.Response(status=401)
+
+    try:
+        data = await request.json()
+    except ValueError:
+        return web.Response(status=400)
+
+    try:
+        _queue.put_nowait((time.perf_counter(), data))
+    except asyncio.QueueFull:
+        # Не 200: Telegram повторит доставку, когда очередь разгрузится
+        stats["rejected"] += 1
+        return web.Response(status=503)
+
+    stats["received"] += 1
+    return web.Response()
+
+
+async def handle_stats(request: web.Request) -> web.Response:
+    if not _authorized(request):
+        return web.Response(status=401)
+    return web.json_response({
+        "queue_depth": queue_depth(),
+        "queue_size": WEBHOOK_QUEUE_SIZE,
+        "workers": WEBHOOK_WORKERS,
+        **stats,
+    })
+
+
+def create_app(dp: Dispatcher, bot: Bot) -> web.Application:
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle_update)
+    app.router.add_get(f"{WEBHOOK_PATH}/stats", handle_stats)
+    app.router.add_get("/metrics", metrics.handle_metrics)
+
+    async def start_workers(app: web.Application):
+        global _queue
+        _queue = asyncio.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+        app["workers"] = [
+            asyncio.create_task(_worker(dp, bot)) for _ in range(WEBHOOK_WORKERS)
+        ]
+
+    async def stop_workers(app: web.Application):
+        # Дорабатываем то, что уже принято, прежде чем гасить воркеры
+        await _queue.join()
+        for task in app["workers"]:
+            task.cancel()
+
+    app.on_startup.append(start_workers)
+    app.on_shutdown.append(stop_workers)
+    return app
+
+
+async def run(dp: Dispatcher, bot: Bot):
+    # Без секрета любой, кто знает путь, может прислать апдейт от имени владельца
+    if not WEBHOOK_SECRET:
+        raise ValueError("WEBHOOK_SECRET not set!")
+
+    app = create_app(dp, bot)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            url=f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()